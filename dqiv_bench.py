@@ -0,0 +1,234 @@
+import os, argparse, logging, sys, json, random, tempfile, time
+import dqiv_patch
+from dqiv_patch import PatchConfig
+
+# Benchmark the patcher on a synthetic corpus, so performance can be measured without the roms.
+#
+#   python3 dqiv_bench.py                   run all benchmarks and compare against bench_baseline.json
+#   python3 dqiv_bench.py --save-baseline   run all benchmarks and store the results as the new baseline
+#   python3 dqiv_bench.py --generate DIR    only write the synthetic .mpt corpus to DIR
+
+# Results are logged through their own logger, so they still show up when the patcher's logging is silenced.
+bench_logger = logging.getLogger('bench')
+bench_logger.setLevel(logging.INFO)
+
+nametags = [b'', b'', b'Alena', b'Borya', b'Kiryl', b'Meena', b'Maya', b'Ragnar', b'Torneko', b'%a00090']
+
+words = [b'the', b'a', b'to', b'and', b'of', b'you', b'we', b'it', b'is', b'that', b'in', b'this', b'for', b'on',
+         b'castle', b'monster', b'sword', b'Zenithia', b'Santeem', b'Endor', b'gold', b'coins', b'journey', b'must',
+         b'never', b'hero', b'travellers', b'inn', b'church', b'king', b'princess', b'forest', b'cave', b'tower',
+         b'shall', b'indeed', b'reckon', b'dunno', b'blimey', b'ye', b'aye', b'wee', b'lass', b'lad', b'sure',
+         b'%a00090', b'%a00090', b'%a02010', b'%a00120']
+
+glyphs = [b'\xe2\x80\x94', b'\xe2\x80\x98', b'\xe2\x80\x99', b'\xe3\x88\xa1', b'\xe2\x93\x86', b'\xe2\x93\x87',
+          b'\xe2\x93\x95', b'\xe2\x93\x96', b'\xe2\x93\x97', b'\xe2\x93\x98', b'\xe2\x93\x99', b'\xe2\x99\xaa', b'%0']
+
+# (masculine, feminine) options for %A gender blocks, mostly ones the rule-based replacement handles.
+gender_options = [(b'he', b'she'), (b'his', b'her'), (b'him', b'her'), (b'himself', b'herself'), (b'man', b'woman'),
+                  (b'sir', b'madam'), (b'guy', b'gal'), (b'boy', b'girl'), (b'son', b'daughter'),
+                  (b'hero', b'heroine'), (b'laddie', b'lassie'), (b'gent', b'lady'), (b'monsieur', b'madame')]
+
+# (first, second) options for %H/%M/%O/%L/%D regular blocks.
+regular_options = {b'%H': [(b'you', b'you lot'), (b'friend', b'friends'), (b'yourself', b'yourselves')],
+                   b'%M': [(b'them', b'it'), (b'those', b'that')],
+                   b'%O': [(b'the girls\'', b'your'), (b'Alena', b'your companion')],
+                   b'%L': [(b'both of you', b'one of you'), (b'sisters', b'sister')],
+                   b'%D': [(b'yourself', b'yourselves')]}
+
+# Lines that trigger the special case rules in dqiv_patch.
+special_lines = [b'%a02010 puts their %a00100 in a different place. ',
+                 b"%a02010's wounds heal! ",
+                 b'%a00110 puts %a02100 in a different place in the bag. ',
+                 b"I'll take that %a00100 off your hands for %a00620 gold coins. Okay?",
+                 b'exchanges their %a00102 armour and weapons for something else. ',
+                 b" Your custom's most appreciated.",
+                 b"They don't notice the party's approach.",
+                 b'%a02180 takes %a02100 out of the bag.',
+                 b"What luck! they's weve got to go, they cares not."]
+
+# Battle text shapes from b0801000.mpt.
+battle_lines = [b'%a00120 appears!', b'%a00120 appear!', b'%a00120 and %a00121 appear!',
+                b'Each party member receives %a00620 experience points.', b'%a02010 attacks!\n%a02180 takes %a00620 damage.',
+                b'%a02010 casts %a00170! ', b'%a02010 is defeated.', b'%a02180 is no longer confused.']
+
+def make_gender_block(rng):
+    masculine, feminine = rng.choice(gender_options)
+    if rng.random() < 0.1:
+        return b'%A000%X' + masculine + b'%Z'
+    block = b'%A000%X' + masculine + b'%Z%B090%X' + feminine + b'%Z'
+    if rng.random() < 0.1:
+        block += b'%C000%Xthey%Z'
+    return block
+
+def make_regular_block(rng, depth=0):
+    control_char = rng.choice(list(regular_options))
+    first, second = rng.choice(regular_options[control_char])
+    if depth == 0 and rng.random() < 0.15:
+        # Nest a block inside the first option.
+        first += b' ' + (make_gender_block(rng) if rng.random() < 0.5 else make_regular_block(rng, depth + 1))
+    return control_char + b'%03d' % rng.randrange(200) + b'%X' + first + b'%Y' + second + b'%Z'
+
+def make_sentence(rng):
+    sentence = []
+    for _ in range(rng.randint(3, 14)):
+        roll = rng.random()
+        if roll < 0.08:
+            sentence.append(make_gender_block(rng))
+        elif roll < 0.14:
+            sentence.append(make_regular_block(rng))
+        elif roll < 0.17:
+            sentence.append(rng.choice(glyphs) + rng.choice(words))
+        else:
+            sentence.append(rng.choice(words))
+    sentence = b' '.join(sentence)
+    return sentence[:1].upper() + sentence[1:] + rng.choice([b'.', b'.', b'!', b'?', b'...'])
+
+def make_segment(rng, battle=False):
+    if battle:
+        body = b' '.join(rng.choice(battle_lines) for _ in range(rng.randint(1, 2)))
+    else:
+        lines = [b' '.join(make_sentence(rng) for _ in range(rng.randint(1, 2))) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.2:
+            lines.insert(rng.randrange(len(lines) + 1), rng.choice(special_lines))
+        body = b'\n'.join(lines)
+    # The segment end marker is usually @c0@ (wait for input), sometimes @c1@-@c3@.
+    return b'@a' + rng.choice(nametags) + b'@b' + body + b'@c%d@' % rng.choice([0, 0, 0, 1, 2, 3])
+
+def make_mpt(rng, segments, battle=False):
+    data = bytearray(b'MPT\x00' + len(b'%d' % segments).to_bytes(4, 'little') + bytes(8))
+    for _ in range(segments):
+        data.extend(make_segment(rng, battle))
+        data.extend(b'\x00' * rng.randint(1, 4))
+    return bytes(data)
+
+# Generate a corpus of {filename: data}, including battle text and party chat files.
+def generate_corpus(files=40, segments=150, seed=0):
+    rng = random.Random(seed)
+    corpus = {'b0801000.mpt': make_mpt(rng, segments, battle=True)}
+    for i in range(files - 1):
+        filename = 'b05%02d000.mpt' % i if i % 3 == 0 else 'b%04d000.mpt' % i
+        corpus[filename] = make_mpt(rng, segments)
+    return corpus
+
+def write_corpus(path, corpus):
+    os.makedirs(path, exist_ok=True)
+    for filename, data in corpus.items():
+        with open(f'{path}/{filename}', "wb") as out_file:
+            out_file.write(data)
+
+def clear_caches():
+    dqiv_patch.control_block_cache.clear()
+    dqiv_patch.segment_cache.clear()
+
+# Time func over the corpus, keeping the best of repeat runs.
+def run_benchmark(name, func, size, segments, repeat):
+    best = None
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {'seconds': best, 'mb_s': size / best / 1e6, 'segments_s': segments / best}
+    bench_logger.info(f'{name:<16} {result["mb_s"]:8.2f} MB/s {result["segments_s"]:10.0f} segments/s {best:8.3f} s')
+    return result
+
+def run_benchmarks(corpus, config, repeat):
+    filenames = sorted(corpus)
+    segments = [(filename, corpus[filename][segment_start:segment_end])
+                for filename in filenames
+                for _, (segment_start, segment_end), _ in dqiv_patch.iter_segments(corpus[filename])]
+    normalize = dqiv_patch.load_substitution_tables(config.rules)['normalize']
+    normalized = [normalize.apply(segment) for _, segment in segments]
+    reduced = [dqiv_patch.process_control_chars(segment, config) for segment in normalized]
+    file_size = sum(len(data) for data in corpus.values())
+    segment_size = sum(len(segment) for _, segment in segments)
+
+    with tempfile.TemporaryDirectory() as path:
+        write_corpus(f'{path}/en', corpus)
+        os.makedirs(f'{path}/out/{config.lang}')
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            def patch_files():
+                for filename in filenames:
+                    dqiv_patch.patch_file_en(filename, config)
+            results = {'patch_file_en': run_benchmark('patch_file_en', patch_files, file_size, len(segments), repeat)}
+        finally:
+            os.chdir(cwd)
+
+    def process_segments():
+        for filename, segment in segments:
+            dqiv_patch.process_segment(filename, segment, config)
+    results['process_segment'] = run_benchmark('process_segment', process_segments, segment_size, len(segments), repeat)
+
+    def process_control_chars():
+        for segment in normalized:
+            dqiv_patch.process_control_chars(segment, config)
+    results['control_chars'] = run_benchmark('control_chars', process_control_chars, segment_size, len(segments), repeat)
+
+    def reflow_segments():
+        for segment in reduced:
+            dqiv_patch.reflow_segment(segment, True, 43, False)
+    results['reflow_segment'] = run_benchmark('reflow_segment', reflow_segments, segment_size, len(segments), repeat)
+
+    return results
+
+# Compare results against a stored baseline and return the names of the benchmarks that regressed.
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result['mb_s'] < baseline[name]['mb_s'] * (1 - tolerance):
+            bench_logger.error(f'{name} regressed: {result["mb_s"]:.2f} MB/s, baseline {baseline[name]["mb_s"]:.2f} MB/s')
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dqiv_patch on a synthetic .mpt corpus.')
+    parser.add_argument('--files', type=int, default=40, help='Number of .mpt files to generate.')
+    parser.add_argument('--segments', type=int, default=150, help='Number of segments per file.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the corpus generator.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the fastest one is reported.')
+    parser.add_argument('--gender', default='n', help='Gender mode to patch with.')
+    parser.add_argument('--lang', default='en', help='Language mode to patch with.')
+    parser.add_argument('--generate', metavar='DIR', help='Write the corpus to DIR and exit.')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='Baseline results file.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline (default 0.2 = 20%%).')
+    args = parser.parse_args()
+
+    # The patcher logs every file and warns about gender blocks it can't handle, only print the results.
+    dqiv_patch.configure_logging(logging.ERROR)
+
+    corpus = generate_corpus(args.files, args.segments, args.seed)
+    if args.generate:
+        write_corpus(args.generate, corpus)
+        bench_logger.info(f'Wrote {len(corpus)} files to {args.generate}')
+        return
+
+    corpus_params = {'files': args.files, 'segments': args.segments, 'seed': args.seed, 'gender': args.gender, 'lang': args.lang}
+    bench_logger.info(f'Corpus: {len(corpus)} files, {sum(len(data) for data in corpus.values())} bytes')
+    results = run_benchmarks(corpus, PatchConfig(gender=args.gender, lang=args.lang), args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({'corpus': corpus_params, 'results': results}, baseline_file, indent=2)
+        bench_logger.info(f'Saved baseline to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        bench_logger.info(f'No baseline at {args.baseline}, run with --save-baseline to store one.')
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['corpus'] != corpus_params:
+        bench_logger.info(f'Baseline {args.baseline} was recorded with {baseline["corpus"]}, not comparing.')
+        return
+    if find_regressions(results, baseline['results'], args.tolerance):
+        sys.exit(1)
+    bench_logger.info(f'No regressions against {args.baseline}.')
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,201 @@
-import os, shutil, argparse, logging, sys, subprocess, requests
-from zipfile import ZipFile
+import os, re, shutil, argparse, logging, sys, struct, mmap, json, functools, hashlib, fnmatch, posixpath, select, tempfile, threading, time, zlib, atexit, contextlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
 
-logging.basicConfig(format='%(message)s', stream=sys.stdout, level=logging.INFO)
+# The patcher can be imported as a library, see Patcher. Modules only needed for rom and obb I/O or for
+# worker processes (zipfile, fcntl, concurrent.futures.process) are imported where they are used, and
+# logging is only configured when run as a script.
 
-mode_gender = 'n'
-mode_lang = 'en'
+# Per-file summary lines. These are still shown when the root logger is quieted with --quiet.
+summary_logger = logging.getLogger('summary')
+summary_logger.setLevel(logging.INFO)
 
 path_to_roms = "roms"
 
-def main():
-    global mode_gender
-    global mode_lang
-    global mode_yuusha
+# Party chat mpt files in the Android obb.
+obb_mpt_pattern = "assets/msg/en/b05*.mpt"
+
+# Mpt files read from the US rom, unless they are all in en.
+us_nds_mptlist = ['b0000000.mpt', 'b0001000.mpt', 'b0002000.mpt', 'b0003000.mpt', 'b0004000.mpt', 'b0005000.mpt', 'b0006000.mpt', 'b0007000.mpt', 'b0008000.mpt', 'b0009000.mpt', 'b0010000.mpt', 'b0011000.mpt', 'b0012000.mpt', 'b0014000.mpt', 'b0015000.mpt', 'b0016000.mpt', 'b0017000.mpt', 'b0018000.mpt', 'b0019000.mpt', 'b0025000.mpt', 'b0026000.mpt', 'b0027000.mpt', 'b0028000.mpt', 'b0029000.mpt', 'b0030000.mpt', 'b0031000.mpt', 'b0032000.mpt', 'b0033000.mpt', 'b0034000.mpt', 'b0035000.mpt', 'b0037000.mpt', 'b0038000.mpt', 'b0039000.mpt', 'b0040000.mpt', 'b0045000.mpt', 'b0046000.mpt', 'b0047000.mpt', 'b0049000.mpt', 'b0050000.mpt', 'b0051000.mpt', 'b0053000.mpt', 'b0054000.mpt', 'b0055000.mpt', 'b0065000.mpt', 'b0066000.mpt', 'b0067000.mpt', 'b0069000.mpt', 'b0070000.mpt', 'b0071000.mpt', 'b0072000.mpt', 'b0073000.mpt', 'b0075000.mpt', 'b0076000.mpt', 'b0077000.mpt', 'b0079000.mpt', 'b0080000.mpt', 'b0081000.mpt', 'b0082000.mpt', 'b0083000.mpt', 'b0084000.mpt', 'b0085000.mpt', 'b0086000.mpt', 'b0087000.mpt', 'b0088000.mpt', 'b0090000.mpt', 'b0091000.mpt', 'b0093000.mpt', 'b0094000.mpt', 'b0095000.mpt', 'b0096000.mpt', 'b0097000.mpt', 'b0098000.mpt', 'b0099000.mpt', 'b0100000.mpt', 'b0101000.mpt', 'b0102000.mpt', 'b0103000.mpt', 'b0104000.mpt', 'b0105000.mpt', 'b0106000.mpt', 'b0107000.mpt', 'b0109000.mpt', 'b0110000.mpt', 'b0112000.mpt', 'b0113000.mpt', 'b0115000.mpt', 'b0116000.mpt', 'b0118000.mpt', 'b0119000.mpt', 'b0120000.mpt', 'b0121000.mpt', 'b0122000.mpt', 'b0123000.mpt', 'b0124000.mpt', 'b0125000.mpt', 'b0126000.mpt', 'b0127000.mpt', 'b0128000.mpt', 'b0129000.mpt', 'b0130000.mpt', 'b0145000.mpt', 'b0146000.mpt', 'b0148000.mpt', 'b0149000.mpt', 'b0150000.mpt', 'b0151000.mpt', 'b0152000.mpt', 'b0153000.mpt', 'b0154000.mpt', 'b0155000.mpt', 'b0156000.mpt', 'b0157000.mpt', 'b0200000.mpt', 'b0600000.mpt', 'b0601000.mpt', 'b0602000.mpt', 'b0606000.mpt', 'b0801000.mpt', 'b0802000.mpt', 'b0803000.mpt', 'b0804000.mpt', 'b0805000.mpt', 'b0806000.mpt', 'b0807000.mpt', 'b0808000.mpt', 'b0810000.mpt', 'b0811000.mpt', 'b0812000.mpt', 'b0813000.mpt', 'b0814000.mpt', 'b0815000.mpt', 'b0816000.mpt', 'b0820000.mpt', 'b0821000.mpt', 'b0822000.mpt', 'b0823000.mpt', 'b0824000.mpt', 'b0825000.mpt', 'b0830000.mpt', 'b0831000.mpt', 'b0832000.mpt', 'b0833000.mpt', 'b0834000.mpt', 'b0901000.mpt', 'b1000000.mpt', 'b1001000.mpt', 'b1002000.mpt', 'b1003000.mpt', 'b1004000.mpt', 'b1005000.mpt', 'b1006000.mpt', 'b1007000.mpt', 'b1010000.mpt']
+
+@dataclass(frozen=True)
+class PatchConfig:
+    # Everything that affects how a file is patched. Passed explicitly so files can be patched in worker processes.
+    gender: str = 'n'
+    lang: str = 'en'
+    yuusha: str = ''
+    # Optional JSON file with extra substitution rules, see load_substitution_tables.
+    rules: str = None
+
+    def __post_init__(self):
+        if self.gender not in ['n', 'm', 'f', 'b']:
+            raise ValueError(f'Unsupported gender: {self.gender}')
+        if self.lang not in ['en', 'ja']:
+            raise ValueError(f'Unsupported lang: {self.lang}')
+        if len(self.yuusha) > 7:
+            raise ValueError(f'Hero name must be 7 characters or less. Zannen desu.')
 
+def main():
     parser = argparse.ArgumentParser(description='Patch English script files for JP Dragon Quest IV ROM.')
     parser.add_argument('--file', help='File to be patched. must be present in the ./en directory. Disables automatic extracting and repacking.', default=None)
     parser.add_argument('--yuusha', help='Player character name. Maximum 7 characters.', default='')
     parser.add_argument('--gender', help='[(n)|m|f|b] player character gender. options are neutral, male, female, both', default='n')
     parser.add_argument('--lang', help='[(en)|ja] rom language mode to target. en uses nametags, ja embeds the speaker name in text', default='en')
     parser.add_argument('--debug', dest='debug', action='store_true', help='Enable debug logs')
+    parser.add_argument('--quiet', action='store_true', help='Only print a summary line per patched file, plus warnings and errors')
     parser.add_argument('--manual', help='Does not run the automatic extractor or repacker. You will have to extract and repack the files yourself.', action='store_true')
+    parser.add_argument('--jobs', help='Number of files to patch in parallel. 0 uses all cores.', type=int, default=1)
+    parser.add_argument('--rules', help='JSON file with extra substitution rules to apply to every segment.', default=None)
+    parser.add_argument('--cache', help='Directory to cache patched files in. Unchanged files are reused from here instead of being patched again.', default='cache')
+    parser.add_argument('--cache-size', help='Maximum size of the cache directory in MB. Least recently used files are evicted first.', type=int, default=256)
+    parser.add_argument('--no-cache', help='Patch every file without using the cache.', action='store_true')
+    parser.add_argument('--segment-cache', help='Number of rendered segments to keep in memory, so segments repeated across files are only patched once. 0 disables it.', type=int, default=65536)
+    parser.add_argument('--verify', help='Check every patched file against its input (markers, bytes outside segments, leftover control codes, line lengths) and write a JSON report, verify.json by default. Exits with an error if there are problems.', nargs='?', const='verify.json', default=None, metavar='REPORT')
+    parser.add_argument('--watch', help='After patching, keep running and re-patch .mpt files in en as they change, updating the patched roms (or out with --manual) and their BPS patches in place. Changing the --rules file re-patches everything.', action='store_true')
+    parser.add_argument('--output', help='[(rom)|bps|both] write patched roms, BPS patches against the JA rom, or both.', choices=['rom', 'bps', 'both'], default='rom')
+    parser.add_argument('--variants', help='Build every combination of the comma separated values given to --gender, --lang and --yuusha, e.g. --gender n,m --lang en,ja. Each file is only parsed once.', action='store_true')
+    parser.add_argument('--index', help='SQLite segment index to write while patching (segments.db by default), and to update with --segment. Read it with the query command.', nargs='?', const='segments.db', default=None, metavar='DB')
+    parser.add_argument('--segment', help='Re-patch only the segment with this id in the --index from en, overwriting just its text in the patched rom (or out with --manual).', type=int, default=None, metavar='ID')
+    parser.add_argument('--profile', help='Record the wall and CPU time of each stage, file and segment rendering step, print a summary and write a Chrome trace (chrome://tracing or Perfetto), profile.json by default.', nargs='?', const='profile.json', default=None, metavar='TRACE')
+    parser.add_argument('--cprofile', help='Also write cProfile stats for this process to PSTATS, e.g. for snakeviz or pstats. Use with --jobs 1 to include patching.', default=None, metavar='PSTATS')
+    subparsers = parser.add_subparsers(dest='command')
+    query = subparsers.add_parser('query', help='List segments in the --index, e.g. "query --code %%A" or "query --at-limit".')
+    query.add_argument('--db', help='Segment index to read, segments.db by default.', default='segments.db')
+    query.add_argument('--file', dest='query_file', help='Only segments in this file.', default=None)
+    query.add_argument('--code', help='Only segments with this control code, e.g. %%A.', default=None)
+    query.add_argument('--rule', help='Only segments where this special case rule fired.', default=None)
+    query.add_argument('--text', help='Only segments whose patched text contains this.', default=None)
+    query.add_argument('--at-limit', help='Only segments with a line at or over the reflow limit.', action='store_true')
+    query.add_argument('--where', help='Extra SQL condition on the segments table.', default=None)
+    query.add_argument('--json', help='Print the rows as JSON.', action='store_true')
+    batch = subparsers.add_parser('batch', help='Build every rom listed in a JSON job manifest, see load_batch_manifest.')
+    batch.add_argument('manifest', help='JSON job manifest.')
+    batch.add_argument('--workers', help='Number of roms to write at once.', type=int, default=2)
+    batch.add_argument('--report', help='Write a JSON report with the result and timings of each job, batch.json by default.', nargs='?', const='batch.json', default=None)
 
     args = parser.parse_args()
+    configure_logging(logging.INFO)
 
-    if args.gender not in ['n', 'm', 'f', 'b']:
-        logging.error(f'Unsupported --gender: {args.gender}')
-        exit(1)
-    if args.lang not in ['en', 'ja']:
-        logging.error(f'Unsupported --lang: {args.lang}')
+    if args.command == 'query':
+        query_index(args)
+        return
+
+    genders = args.gender.split(',') if args.variants else [args.gender]
+    langs = args.lang.split(',') if args.variants else [args.lang]
+    yuushas = args.yuusha.split(',') if args.variants else [args.yuusha]
+    if args.watch and args.output == 'bps':
+        logging.error('--watch updates the patched roms, so it needs --output rom or both')
         exit(1)
-    if len(args.yuusha) > 7:
-        logging.error(f'Hero name must be 7 characters or less. Zannen desu.')
+    if args.jobs < 0:
+        logging.error(f'Unsupported --jobs: {args.jobs}')
         exit(1)
+    segment_cache.max_entries = args.segment_cache
     if args.debug:
         root = logging.getLogger()
         root.setLevel(logging.DEBUG)
-    mode_gender = args.gender
-    mode_lang = args.lang
-    mode_manual = args.manual
-    path_to_ndstool = "ndstool"
+    elif args.quiet:
+        root = logging.getLogger()
+        root.setLevel(logging.WARNING)
+    if args.profile is not None or args.cprofile is not None:
+        start_profiling(args.profile, args.cprofile)
+    if args.rules is not None:
+        # Check the rules file up front, rather than in the middle of patching.
+        try:
+            load_substitution_tables(args.rules)
+        except (ValueError, OSError) as e:
+            logging.error(f'Bad --rules file {args.rules}: {e}')
+            exit(1)
 
-    logging.info(f"Patching directory en, writing results to 'out/{mode_lang}'")
-    
-    shutil.rmtree("out", ignore_errors=True)
-    os.mkdir("out")
-    os.mkdir(f"out/{mode_lang}")
+    if args.command == 'batch':
+        try:
+            jobs = load_batch_manifest(args.manifest, args.rules)
+        except (ValueError, KeyError, OSError) as e:
+            logging.error(f'Bad batch manifest {args.manifest}: {e}')
+            exit(1)
+        cache = None if args.no_cache else PatchCache(args.cache, args.cache_size * 1024 * 1024)
+        results = run_batch(jobs, max(args.workers, 1), args.jobs or os.cpu_count(), cache)
+        if cache is not None:
+            cache.evict()
+            summary_logger.info('Cache: %d hits, %d misses', cache.hits, cache.misses)
+        if args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(results, f, indent=2)
+        if not all(result['ok'] for result in results):
+            sys.exit(1)
+        return
 
-    if args.file is not None:
-        mode_manual = True
-        patch_file_en(args.file)
-    else:
-        if not mode_manual:
-            path_to_ndstool = automatic_extract_repack()
-        
-        files = os.listdir('en')
-        for file in files:
-            patch_file_en(f'{file}')
+    try:
+        configs = [PatchConfig(gender=gender, lang=lang, yuusha=yuusha, rules=args.rules) for gender in genders for lang in langs for yuusha in yuushas]
+    except ValueError as e:
+        logging.error(e)
+        exit(1)
+    out_dirs = [variant_out_dir(config, args.variants) for config in configs]
+
+    if args.segment is not None:
+        try:
+            repatch_segment(open_index(args.index or 'segments.db'), args.segment, args.rules, args.manual, args.variants)
+        except (ValueError, OSError) as e:
+            logging.error(e)
+            exit(1)
+        return
+    mode_manual = args.manual
+    cache = None if args.no_cache else PatchCache(args.cache, args.cache_size * 1024 * 1024)
+    writers = []
+    source_files = {}
+
+    # Copying the JA rom, reading the obb and patching are independent stages, so they share a small thread pool.
+    with ThreadPoolExecutor(max_workers=4) as stages:
+        if args.file is not None:
+            mode_manual = True
+            files = dict(directory_source('en', [args.file]))
+        else:
+            if not mode_manual:
+                writers, source_files = automatic_extract_repack(configs, stages)
+
+            # Files in en take precedence over the ones read from the US rom and obb.
+            files = dict(source_files)
+            files.update(directory_source('en'))
+
+        # Patched files are passed straight from the patcher to the roms, or to the out directory with --manual.
+        stats = [Counter() for config in configs]
+        records = {} if args.index is not None else None
+        stream = patch_stream(files, configs, args.jobs or os.cpu_count(), cache, stats, records)
+        problems = []
+        if args.verify is not None:
+            stream = verify_stream(stream, files, configs, problems)
+        if args.index is not None:
+            stream = index_stream(stream, files, configs, open_index(args.index), records)
+        try:
+            if mode_manual:
+                for out_dir in out_dirs:
+                    logging.info(f"Patching directory en, writing results to '{out_dir}'")
+                shutil.rmtree("out", ignore_errors=True)
+                write_out_dirs(stream, out_dirs)
+            else:
+                write_roms(stream, configs, writers, args.output)
+        except PatchError as e:
+            e.log()
+            exit(1)
+
+    for config, config_stats in zip(configs, stats):
+        log_file_summary(f'{len(files)} files' if len(configs) == 1 else f'{len(files)} files [{variant_name(config)}]', config_stats)
+    totals = sum(stats, Counter())
+    log_rule_coverage(totals)
+    if totals['segment cache hits'] + totals['segment cache misses'] > 0:
+        summary_logger.info('Segment cache: %d hits, %d misses (%.1f%% of segments were repeats)', totals['segment cache hits'], totals['segment cache misses'],
+                            100 * totals['segment cache hits'] / (totals['segment cache hits'] + totals['segment cache misses']))
+    if cache is not None:
+        cache.evict()
+        summary_logger.info('Cache: %d hits, %d misses', cache.hits, cache.misses)
+    if args.verify is not None:
+        write_verify_report(args.verify, files, configs, problems)
+        if problems and not args.watch:
+            sys.exit(1)
 
-    if not mode_manual:
-        repack(mode_gender=mode_gender, mode_lang=mode_lang, path_to_ndstool=path_to_ndstool)
+    if args.watch:
+        roms = [writer.result() for writer in writers] if args.output == 'both' else None
+        watch(configs, out_dirs if mode_manual else None, cache, args.rules, args.verify is not None, source_files, roms)
 
     # Prologue
     # patch_file_en("b0200000.mpt")
@@ -78,6 +215,265 @@ def main():
     # Battle text
     # patch_file_en('b0801000.mpt')
 
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x002, 0x008, 0x040, 0x080, 0x100, 0x200
+
+class SourceWatcher:
+    # Wait for changes in a few directories. Uses inotify on Linux and falls back to polling elsewhere. Either
+    # way, wait() only says that something may have changed; callers compare file states to find out what.
+    def __init__(self, paths, interval=0.5):
+        self.interval = interval
+        self.fd = None
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            for path in paths:
+                if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+            self.fd = fd
+        except (OSError, AttributeError, TypeError):
+            logging.debug('inotify is not available, polling for changes every %.1f s', interval)
+
+    def wait(self):
+        if self.fd is None:
+            time.sleep(self.interval)
+            return
+        select.select([self.fd], [], [])
+        # Editors often write a file in several steps, so wait a moment and take all the events at once.
+        time.sleep(0.05)
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+def source_states(path, rules=None):
+    # (mtime, size) of each mpt file in path, plus the rules file.
+    states = {entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size) for entry in os.scandir(path) if entry.name.endswith('.mpt')}
+    if rules is not None and os.path.exists(rules):
+        states[rules] = (os.stat(rules).st_mtime_ns, os.stat(rules).st_size)
+    return states
+
+def watch(configs, out_dirs, cache, rules=None, verify=False, source_files=None, roms=None):
+    # Keep re-patching the mpt files in en as they change. Patched files are written to out_dirs, or straight
+    # into the previously patched roms if out_dirs is None. source_files are the files read from the US rom and
+    # obb, which are patched again when the rules change or when the file overriding them in en is removed.
+    # roms are the closed writers from write_roms if their BPS patches should be kept up to date.
+    source_files = source_files or {}
+    watcher = SourceWatcher(['en', os.path.dirname(os.path.abspath(rules))] if rules is not None else ['en'])
+    states = source_states('en', rules)
+    logging.info('Watching en for changes, press Ctrl+C to stop.')
+    try:
+        while True:
+            watcher.wait()
+            new_states = source_states('en', rules)
+            changed = sorted(name for name, state in new_states.items() if states.get(name) != state)
+            removed = sorted(name for name in states if name not in new_states and name != rules)
+            states = new_states
+            if not changed and not removed:
+                continue
+
+            start = time.perf_counter()
+            if rules in changed:
+                # The rules are compiled once per process, so drop everything derived from the old ones.
+                load_substitution_tables.cache_clear()
+                patcher_version.cache_clear()
+                segment_cache.clear()
+                logging.info(f'{rules} changed, re-patching every file')
+                files = {**source_files, **dict(directory_source('en'))}
+            else:
+                # Files removed from en go back to the version read from the US rom or obb.
+                files = {name: source_files[name] for name in removed if name in source_files}
+                files.update(directory_source('en', changed))
+            if not files:
+                continue
+            stream = patch_stream(files, configs, 1, cache)
+            problems = []
+            if verify:
+                stream = verify_stream(stream, files, configs, problems)
+            try:
+                if out_dirs is not None:
+                    write_out_dirs(stream, out_dirs)
+                else:
+                    write_roms_in_place(stream, configs, roms)
+            except PatchError as e:
+                # Keep watching, the file is probably mid-edit.
+                e.log()
+                continue
+            except Exception as e:
+                # Keep watching, the file is probably mid-edit.
+                logging.error(f'Failed to re-patch {", ".join(sorted(files))}: {e!r}')
+                continue
+            summary_logger.info('Re-patched %d files in %.0f ms%s', len(files), (time.perf_counter() - start) * 1000,
+                                f', {len(problems)} verification problems' if problems else '')
+    except KeyboardInterrupt:
+        logging.info('Stopped watching.')
+    finally:
+        watcher.close()
+
+@dataclass(frozen=True)
+class BatchJob:
+    # One rom to build in batch mode.
+    name: str
+    ja: str
+    us: str
+    obb: str
+    en: str
+    config: PatchConfig
+    output: str
+    path: str
+
+def load_batch_manifest(path, rules=None):
+    # The manifest is a JSON object with a "jobs" list. Each job names its roms and config, and keys it leaves
+    # out are taken from "defaults", e.g.
+    # {"defaults": {"ja": "roms/ja.nds", "us": "roms/us.nds", "obb": "roms/main.obb"},
+    #  "jobs": [{"name": "neutral"}, {"name": "female-ja", "gender": "f", "lang": "ja", "output": "bps"}]}
+    with open(path) as f:
+        manifest = json.load(f)
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for i, entry in enumerate(manifest['jobs']):
+        entry = {**defaults, **entry}
+        name = entry.get('name', f'job {i + 1}')
+        config = PatchConfig(entry.get('gender', 'n'), entry.get('lang', 'en'), entry.get('yuusha', ''), entry.get('rules', rules))
+        if config.rules is not None:
+            load_substitution_tables(config.rules)
+        if 'ja' not in entry:
+            raise ValueError(f'{name}: no JA rom given')
+        if entry.get('output', 'rom') not in ['rom', 'bps', 'both']:
+            raise ValueError(f'{name}: unsupported output: {entry["output"]}')
+        path_to_rom = entry.get('path', f'patched/{name}.nds' if 'name' in entry else patched_rom_path(config))
+        jobs.append(BatchJob(name, entry['ja'], entry.get('us'), entry.get('obb'), entry.get('en', 'en'), config, entry.get('output', 'rom'), path_to_rom))
+    clashes = [path for path, count in Counter(os.path.abspath(job.path) for job in jobs).items() if count > 1]
+    if clashes:
+        raise ValueError(f'More than one job writes {", ".join(clashes)}')
+    return jobs
+
+def batch_source_key(job):
+    # Jobs reading the same US rom and obb dumps, by content, and the same en directory share their sources.
+    digests = [file_digest(path, os.stat(path).st_mtime_ns) if path is not None else None for path in (job.us, job.obb)]
+    return (*digests, os.path.abspath(job.en))
+
+def read_batch_sources(path_to_us, path_to_obb, en):
+    # Like automatic_extract_repack, for the roms named by a batch job. Problems raise instead of exiting.
+    files = {}
+    if any(not os.path.exists(f'{en}/{nds_mpt}') for nds_mpt in us_nds_mptlist):
+        if path_to_us is None:
+            raise ValueError(f'{en} is missing US NDS mpt files and no US rom was given')
+        info = identify_rom(path_to_us)
+        if rom_games.get(info.game_code) != "us" or info.problem is not None:
+            raise ValueError(f'{path_to_us} is not a clean US DQIV rom ({info.problem or "game code " + info.game_code})')
+        files.update(NdsRom(path_to_us).listdir("data/MESS/en"))
+    if path_to_obb is not None:
+        files.update(read_obb(path_to_obb))
+    elif not any(fnmatch.fnmatchcase(f, "b05*.mpt") for f in os.listdir(en)):
+        raise ValueError(f'No obb given and {en} has no party chat mpt files')
+    files.update(directory_source(en))
+    return files
+
+def run_batch_job(job, patched):
+    # Write one job's rom into a scratch directory next to its output, and only move the results into place
+    # once they are complete, so failed or overlapping jobs never leave a half written rom behind.
+    # Returns the time taken by each step in ms.
+    timings = {}
+    start = time.perf_counter()
+    info = identify_rom(job.ja)
+    if rom_games.get(info.game_code) != "ja" or info.problem is not None:
+        raise ValueError(f'{job.ja} is not a clean JA DQIV rom ({info.problem or "game code " + info.game_code})')
+    out_dir = os.path.dirname(job.path) or '.'
+    os.makedirs(out_dir, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='.batch-', dir=out_dir)
+    try:
+        path_to_rom = os.path.join(scratch, os.path.basename(job.path))
+        writer = PatchedRomWriter(job.ja, path_to_rom)
+        timings['copy'] = (time.perf_counter() - start) * 1000
+        try:
+            for filename, patched_data in patched.items():
+                with profiler.span('write rom', 'file', file=filename):
+                    writer.replace("data/MESS/" + job.config.lang + "/" + filename, patched_data)
+        finally:
+            writer.close()
+        timings['write'] = (time.perf_counter() - start) * 1000 - timings['copy']
+
+        if job.output in ['bps', 'both']:
+            path_to_patch = os.path.splitext(path_to_rom)[0] + ".bps"
+            with profiler.span('bps patch', rom=job.path):
+                write_bps_patch(writer, path_to_patch)
+            timings['bps'] = (time.perf_counter() - start) * 1000 - timings['copy'] - timings['write']
+            os.replace(path_to_patch, os.path.splitext(job.path)[0] + ".bps")
+        if job.output in ['rom', 'both']:
+            os.replace(path_to_rom, job.path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    timings['total'] = (time.perf_counter() - start) * 1000
+    return timings
+
+def batch_outputs(job):
+    return ([job.path] if job.output in ['rom', 'both'] else []) + ([os.path.splitext(job.path)[0] + ".bps"] if job.output in ['bps', 'both'] else [])
+
+def run_batch(jobs, workers=2, patch_jobs=1, cache=None):
+    # Build every job. Jobs sharing their sources (see batch_source_key) read them once and patch them once for
+    # all of their configs, then each job's rom is written on a pool of workers threads while the next group is
+    # patched. Returns a result dict per job, in order.
+    start = time.perf_counter()
+    results = [{'name': job.name, 'ok': False, 'error': None, 'outputs': batch_outputs(job), 'variant': variant_name(job.config), 'ms': {}} for job in jobs]
+    groups = {}
+    for i, job in enumerate(jobs):
+        try:
+            groups.setdefault(batch_source_key(job), []).append(i)
+        except OSError as e:
+            results[i]['error'] = str(e)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for members in groups.values():
+            group_start = time.perf_counter()
+            first = jobs[members[0]]
+            configs = list(dict.fromkeys(jobs[i].config for i in members))
+            try:
+                files = read_batch_sources(first.us, first.obb, first.en)
+                patched = {config: {} for config in configs}
+                for filename, variants in patch_stream(files, configs, patch_jobs, cache):
+                    for config, patched_data in zip(configs, variants):
+                        patched[config][filename] = patched_data
+            except Exception as e:
+                # A bad source only fails the jobs using it.
+                for i in members:
+                    results[i]['error'] = str(e)
+                continue
+            patch_ms = (time.perf_counter() - group_start) * 1000
+            for i in members:
+                results[i]['ms']['patch'] = patch_ms
+                results[i]['shared'] = len(members)
+                futures[i] = pool.submit(run_batch_job, jobs[i], patched[jobs[i].config])
+
+        for i, future in futures.items():
+            try:
+                results[i]['ms'].update(future.result())
+                results[i]['ms'] = {step: round(ms, 1) for step, ms in results[i]['ms'].items()}
+                results[i]['ok'] = True
+            except Exception as e:
+                results[i]['error'] = str(e)
+
+    for result in results:
+        if result['ok']:
+            summary_logger.info('%s: wrote %s in %.0f ms (patching %.0f ms%s; copy %.0f ms, write %.0f ms%s)',
+                                result['name'], ', '.join(result['outputs']), result['ms']['total'], result['ms']['patch'],
+                                f', shared by {result["shared"]} jobs' if result['shared'] > 1 else '', result['ms']['copy'], result['ms']['write'],
+                                f', bps {result["ms"]["bps"]:.0f} ms' if 'bps' in result['ms'] else '')
+        else:
+            logging.error(f'{result["name"]}: failed: {result["error"]}')
+    summary_logger.info('Batch: %d of %d jobs built from %d sets of sources in %.1f s', sum(result['ok'] for result in results), len(results),
+                        len(groups), time.perf_counter() - start)
+    return results
+
 def is_control_char(bytes):
     return is_regular_control_char(bytes) or is_gender_control_char(bytes)
 
@@ -93,7 +489,7 @@ def is_gender_control_char(bytes):
 def is_gender_secondary_control_char(bytes):
     return bytes == b'%B' or bytes == b'%C'
 
-def replace_control_segment(control_char, options):
+def replace_control_segment(control_char, options, config):
     assert is_control_char(control_char), f'Attempted to replace non-control-char: {control_char}'
 
     if control_char == b'%H':
@@ -115,11 +511,11 @@ def replace_control_segment(control_char, options):
     elif control_char == b'%A':
         # Rewrite %A***%X<masculine>%Z%B***%X<feminine>%Z%C***%X<non-gendered>%Z blocks 
         # using specific gender mode or rule-based replacement.
-        if mode_gender == 'b':
+        if config.gender == 'b':
             return bytearray('/', 'utf-8').join(options)
-        elif mode_gender == 'm':
+        elif config.gender == 'm':
             return options[0]
-        elif mode_gender == 'f':
+        elif config.gender == 'f':
             if len(options) > 1:
                 return options[1]
             return options[0]
@@ -165,111 +561,181 @@ def replace_control_segment(control_char, options):
             return options[0]
     raise
 
-def reduce_control_segment(segment):
-    is_regular = is_regular_control_char(segment[0:2])
-    is_gender = is_gender_control_char(segment[0:2])
-    assert is_regular or is_gender, f'Attempted to reduce non-control segment: {segment}'
-    if is_gender:
-        return reduce_gender_control_segment(segment)
-    return reduce_regular_control_segment(segment)
-
-def reduce_regular_control_segment(segment):
-    size = len(segment)
+@dataclass
+class ControlBlock:
+    # A parsed control block, e.g. %H000%X<option>%Y<option>%Z, spanning segment[start:end].
+    # Blocks nested inside the options are kept as children.
+    control_char: bytes
+    start: int
+    end: int = None
+    options: list = None
+    children: list = None
+    raw: bytes = None
+
+# Matches the start of any regular or gender control block.
+control_char_pattern = re.compile(rb'%[HMOLDA]')
+
+# Reduced control blocks by (raw block bytes, gender). The same blocks repeat heavily across the script.
+control_block_cache = {}
+
+def parse_control_block(segment, start, end):
+    # Parse the control block at segment[start:] without slicing the rest of the segment.
+    # The block may not extend past end.
+    block = ControlBlock(bytes(segment[start:start+2]), start, options=[bytearray("", 'utf-8')], children=[])
+    is_gender = is_gender_control_char(block.control_char)
 
-    pointer = 0
     # Control segment starts appear to always be 7 bytes
-    pointer = pointer + 7
-
-    options = [bytearray("", 'utf-8')]
-    options_index = 0
+    pointer = start + 7
+
+    while pointer < end:
+        # Copy everything up to the next % into the current option.
+        next_pointer = segment.find(b'%', pointer, end)
+        if next_pointer < 0:
+            next_pointer = end
+        block.options[-1].extend(segment[pointer:next_pointer])
+        pointer = next_pointer
+        if pointer >= end:
+            break
 
-    while pointer < size:
-        if is_control_char(segment[pointer:pointer+2]):
-            rcs, cs = reduce_control_segment(segment[pointer:])
-            pointer += len(cs)
-        elif is_regular_secondary_control_char(segment[pointer:pointer+2]):
-            options.append(bytearray("", 'utf-8'))
-            options_index += 1
+        code = segment[pointer:pointer+2]
+        if is_control_char(code):
+            child = parse_control_block(segment, pointer, end)
+            block.children.append(child)
+            pointer = child.end
+        elif not is_gender and is_regular_secondary_control_char(code):
+            block.options.append(bytearray("", 'utf-8'))
             pointer += 2
-        elif segment[pointer:pointer+2] == b'%Z':
+        elif is_gender and is_gender_secondary_control_char(code):
+            block.options.append(bytearray("", 'utf-8'))
+            pointer += 7
+        elif code == b'%Z':
             pointer += 2
-            break
+            # Gender blocks continue if there are further gender options after this one.
+            if not is_gender or not is_gender_secondary_control_char(segment[pointer:pointer+2]):
+                break
         else:
-            options[options_index].append(segment[pointer])
+            block.options[-1].append(segment[pointer])
             pointer += 1
 
-    control_segment = segment[0:pointer]
-    reduced_control_segment = replace_control_segment(segment[0:2], options)
+    block.end = min(pointer, end)
+    return block
 
-    logging.debug(f'***Found control segment: {control_segment}***')
-    logging.debug(f'***Reduced control segment: {reduced_control_segment}***')
-    logging.debug(f'Regular options: {options}')
+def reduce_control_block(block, config):
+    # Nested blocks are reduced for their warnings, but only the text of the outer block's options is kept.
+    for child in block.children:
+        reduce_control_block(child, config)
 
-    return reduced_control_segment, control_segment
+    reduced_control_segment = replace_control_segment(block.control_char, block.options, config)
 
-def reduce_gender_control_segment(segment):
-    size = len(segment)
+    logging.debug('***Found control segment: %s***', block)
+    logging.debug('***Reduced control segment: %s***', reduced_control_segment)
 
-    pointer = 0
-    # Control segment starts appear to always be 7 bytes
-    pointer = pointer + 7
+    return reduced_control_segment
 
-    options = [bytearray("", 'utf-8')]
-    options_index = 0
+def parse_control_chars(segment):
+    # Split the segment into literal bytes and ControlBlocks.
+    parts = []
 
-    while pointer < size:
-        if is_control_char(segment[pointer:pointer+2]):
-            rcs, cs = reduce_control_segment(segment[pointer:])
-            pointer += len(cs)
-        elif is_gender_secondary_control_char(segment[pointer:pointer+2]):
-            options.append(bytearray("", 'utf-8'))
-            options_index += 1
-            pointer += 7
-        elif segment[pointer:pointer+2] == b'%Z':
-            pointer += 2
-            # Check if we have any further gender options after this one.
-            # If not, we can end.
-            if not is_gender_secondary_control_char(segment[pointer:pointer+2]):
-                break
-        else:
-            options[options_index].append(segment[pointer])
-            pointer += 1
+    pointer = 0
+    for match in control_char_pattern.finditer(segment):
+        if match.start() < pointer:
+            # Already consumed as part of the previous block.
+            continue
+        parts.append(bytes(segment[pointer:match.start()]))
 
-    control_segment = segment[0:pointer]
-    reduced_control_segment = replace_control_segment(segment[0:2], options)
+        block = parse_control_block(segment, match.start(), len(segment))
+        block.raw = bytes(segment[block.start:block.end])
+        parts.append(block)
+        pointer = block.end
 
-    logging.debug(f'***Found gender control segment: {control_segment}***')
-    logging.debug(f'***Reduced gender control segment: {reduced_control_segment}***')
-    logging.debug(f'Gender options: {options}')
+    parts.append(bytes(segment[pointer:]))
 
-    return reduced_control_segment, control_segment
+    return parts
 
-def process_control_chars(segment):
-    size = len(segment)
-    # Step through segment 
+def render_control_chars(parts, config, stats=None):
     processed_segment = bytearray("", 'utf-8')
 
-    pointer = 0
-    while pointer < size:
-        if is_control_char(segment[pointer:pointer+2]):
-            reduced_control_segment, control_segment = reduce_control_segment(segment[pointer:])
-            processed_segment.extend(reduced_control_segment)
-            pointer += len(control_segment)
+    for part in parts:
+        if isinstance(part, ControlBlock):
+            key = (part.raw, config.gender)
+            if key not in control_block_cache:
+                control_block_cache[key] = bytes(reduce_control_block(part, config))
+            processed_segment.extend(control_block_cache[key])
+            if stats is not None:
+                stats['control blocks'] += 1
         else:
-            # Write the current byte as-is
-            processed_segment.append(segment[pointer])
-            pointer += 1
+            # Write the bytes between blocks as-is
+            processed_segment.extend(part)
 
     return processed_segment
 
-def fix_grammar(segment):
-    fixed_segment = segment
-    fixed_segment = fixed_segment.replace(b"they's", b"they are")
-    fixed_segment = fixed_segment.replace(b'weve ', b"we've")
-    fixed_segment = fixed_segment.replace(b'Weve ', b"We've")
-    fixed_segment = fixed_segment.replace(b"What luck!", b"Found")
-    fixed_segment = fixed_segment.replace(b'they cares', b'they care')
-    return bytearray(fixed_segment)
+def process_control_chars(segment, config, stats=None):
+    return render_control_chars(parse_control_chars(segment), config, stats)
+
+# Byte substitutions applied to every segment, by stage. normalize runs before control chars are reduced,
+# grammar fixes issues caused by the replacements afterwards.
+default_substitutions = {
+    'normalize': [
+        # Strip all %0 control characters.
+        (b'%0', b''),
+        # Strip or replace special characters that aren't rendered correctly in English and show up as "%".
+        (b'\xe2\x80\x94', b'-'),
+        (b'\xe2\x80\x98', b'"'),
+        (b'\xe2\x80\x99', b'"'),
+        (b'\xe3\x88\xa1', b''),
+        (b'\xe2\x93\x86', b''),
+        (b'\xe2\x93\x87', b''),
+        (b'\xe2\x93\x95', b''),
+        (b'\xe2\x93\x96', b''),
+        (b'\xe2\x93\x97', b''),
+        (b'\xe2\x93\x98', b''),
+        (b'\xe2\x93\x99', b''),
+        (b'\xe2\x99\xaa', b'~'),
+    ],
+    'grammar': [
+        (b"they's", b"they are"),
+        (b'weve ', b"we've"),
+        (b'Weve ', b"We've"),
+        (b"What luck!", b"Found"),
+        (b'they cares', b'they care'),
+    ],
+}
+
+class SubstitutionTable:
+    # A set of byte substitutions compiled into a single regex, so a segment is scanned once
+    # no matter how many rules there are.
+    def __init__(self, substitutions):
+        self.substitutions = dict(substitutions)
+        # Prefer the longest rule when several match at the same position.
+        patterns = sorted(self.substitutions, key=len, reverse=True)
+        self.pattern = re.compile(b'|'.join(re.escape(p) for p in patterns)) if patterns else None
+
+    def apply(self, segment):
+        if self.pattern is None:
+            return segment
+        return self.pattern.sub(lambda match: self.substitutions[match.group(0)], segment)
+
+@functools.lru_cache(maxsize=None)
+def load_substitution_tables(path=None):
+    # Compile the default substitutions, extended by the rules in the JSON file at path if given. The file maps
+    # each stage to a list of [find, replace] pairs, e.g. {"grammar": [["they was", "they were"]]}.
+    substitutions = {stage: dict(rules) for stage, rules in default_substitutions.items()}
+    if path is not None:
+        with open(path, encoding='utf-8') as f:
+            stages = json.load(f)
+        if not isinstance(stages, dict):
+            raise ValueError(f'{path} must map each stage to a list of [find, replace] pairs')
+        for stage, rules in stages.items():
+            if stage not in substitutions:
+                raise ValueError(f'Unknown substitution stage "{stage}" in {path}')
+            for rule in rules:
+                if not (isinstance(rule, list) and len(rule) == 2 and all(isinstance(text, str) for text in rule)):
+                    raise ValueError(f'Substitution rule {rule!r} in {path} is not a [find, replace] pair')
+                substitutions[stage][rule[0].encode('utf-8')] = rule[1].encode('utf-8')
+    return {stage: SubstitutionTable(rules) for stage, rules in substitutions.items()}
+
+def fix_grammar(segment, config):
+    return bytearray(load_substitution_tables(config.rules)['grammar'].apply(segment))
 
 def reflow_segment(segment, force=False, reflow_limit=43, newline_end=True):
     # Check if we need to reflow at all. If not, return the original segment.
@@ -311,121 +777,251 @@ def reflow_segment(segment, force=False, reflow_limit=43, newline_end=True):
 
     return reflowed_segment
 
-# Process a single "segment" of dialogue.
+@dataclass(frozen=True)
+class SpecialCaseRule:
+    name: str
+    pattern: bytes
+    # newline_after: change the last byte of the match (a space) to a newline.
+    # newline_before: change the first byte of the match to a newline.
+    # newline_end: change the last byte of the segment to a newline.
+    # replace: replace the whole segment with replacement.
+    # join: change all newlines in the segment to spaces.
+    action: str
+    replacement: bytes = None
+
+# Special cases for segments in every file, matched against the reflowed segment with newlines changed to spaces.
+# All matching newline rules are applied, then the first matching replace or join rule.
+special_case_rules = [
+    SpecialCaseRule('exchanges-their', b'exchanges their %a00102 ', 'newline_after'),
+    SpecialCaseRule('puts-their', b'puts their %a00100 ', 'newline_after'),
+    SpecialCaseRule('puts-item', b'puts %a02100 ', 'newline_after'),
+    SpecialCaseRule('takes-item', b'takes %a02100 ', 'newline_after'),
+    SpecialCaseRule('custom-appreciated', b" Your custom's most appreciated.", 'newline_before'),
+
+    SpecialCaseRule('item-exchange', b"%a02010's %a00101 is exchanged for %a02180's %a00102.", 'replace', b"%a02010's %a00101 is exchanged for\n%a02180's %a00102."),
+    SpecialCaseRule('item-moved', b'%a02010 puts their %a00100 in a different place. ', 'replace', b'%a02010 puts their %a00100\nin a different place. '),
+    SpecialCaseRule('bag-item-moved', b'%a00110 puts %a02100 in a different place in the bag. ', 'replace', b'%a00110 puts %a02100\nin a different place in the bag. '),
+    SpecialCaseRule('shop-sell', b"I'll take that %a00100 off your hands for %a00620 gold coins. Okay?", 'replace', b"I'll take that %a00100 off your\nhands for %a00620 gold coins. Okay?"),
+    SpecialCaseRule('shop-sell-price', b"%a04100? I'll give you %a00620 gold coins for it. Okay?", 'replace', b"%a04100? I'll give you %a00620\ngold coins for it. Okay?"),
+    # special case control character for yggdrasil leaf that doesn't have a good choice available.
+    SpecialCaseRule('yggdrasil-leaf', b'%a02010 mashes up the Yggdrasil leaf and administers it to %N180%Xthemself%Y%a02180%Z.', 'replace', b'%a02010 mashes up the\nYggdrasil leaf and administers it.'),
+    # typo in original script
+    SpecialCaseRule('divine-protection', b'*: May divine protection accompany the great , %a00090.', 'replace', b'*: May divine protection accompany the\ngreat %a00090.'),
+    # better formatting for multiheal
+    SpecialCaseRule('wounds-heal', b"%a02010's wounds heal! ", 'replace', b"%a02010's wounds heal!\n"),
+    SpecialCaseRule('wounds-heal-target', b"%a02180's wounds heal! ", 'replace', b"%a02180's wounds heal!\n"),
+    SpecialCaseRule('casts-spell', b"%a02010 casts %a00170! ", 'replace', b"%a02010 casts %a00170!\n"),
+    # This line is rendered in small font and doesn't need any newlines.
+    SpecialCaseRule('party-unnoticed', b"t notice the party's ", 'join'),
+    SpecialCaseRule('bag-take', b"%a02180 takes %a02100 out of the bag.", 'join'),
+    SpecialCaseRule('bag-put', b"%a00120 puts %a02100 into the bag.", 'join'),
+    SpecialCaseRule('bag-put-self', b'%a02010 puts %a02100 in the bag.', 'join'),
+]
+
+# Special cases for battle text in b0801000.mpt, matched against the reflowed segment and applied in order.
+battle_text_rules = [
+    # Enemy name announcements should end with newline.
+    SpecialCaseRule('enemy-appears', b'appears!', 'newline_end'),
+    SpecialCaseRule('enemies-appear', b'appear!', 'newline_end'),
+    # Experience points message should not have any newlines.
+    SpecialCaseRule('experience', b'Each party member receives', 'join'),
+]
+
+class RuleMatcher:
+    # Finds the first occurrence of every rule pattern in a segment. Each pattern is searched for with
+    # bytes.find, which runs in C and beats a single alternation regex (which tries every pattern in turn at
+    # every position) at any realistic number of rules.
+    def __init__(self, rules):
+        self.rules = rules
+        self.patterns = [(i, rule.pattern) for i, rule in enumerate(rules)]
+
+    def match(self, segment):
+        # Return {rule index: position of its first match}
+        matches = {}
+        for index, pattern in self.patterns:
+            position = segment.find(pattern)
+            if position >= 0:
+                matches[index] = position
+        return matches
+
+special_case_matcher = RuleMatcher(special_case_rules)
+battle_text_matcher = RuleMatcher(battle_text_rules)
+
+def apply_battle_text_rules(segment, stats=None):
+    matches = battle_text_matcher.match(segment)
+    for index in sorted(matches):
+        rule = battle_text_rules[index]
+        # An earlier rule may have changed the end of the segment, overwriting this match.
+        if segment[matches[index]:matches[index] + len(rule.pattern)] != rule.pattern:
+            continue
+        if rule.action == 'newline_end':
+            segment[len(segment)-1] = ord('\n')
+        elif rule.action == 'join':
+            segment = bytearray(segment.replace(b'\n', b' '))
+        if stats is not None:
+            stats[f'rule {rule.name}'] += 1
+    return segment
+
+def apply_special_case_rules(segment, stats=None):
+    segment_no_newlines = bytearray(segment.replace(b'\n', b' '))
+    matches = special_case_matcher.match(segment_no_newlines)
+    fired = []
+
+    for index in sorted(matches):
+        rule = special_case_rules[index]
+        if rule.action == 'newline_after':
+            segment[matches[index] + len(rule.pattern) - 1] = ord(b'\n')
+            fired.append(rule)
+        elif rule.action == 'newline_before':
+            segment[matches[index]] = ord(b'\n')
+            fired.append(rule)
+
+    for index in sorted(matches):
+        rule = special_case_rules[index]
+        if rule.action == 'replace':
+            segment = bytearray(rule.replacement)
+        elif rule.action == 'join':
+            segment = segment_no_newlines
+        else:
+            continue
+        fired.append(rule)
+        break
+
+    if stats is not None:
+        for rule in fired:
+            stats[f'rule {rule.name}'] += 1
+    return segment
+
+@dataclass
+class ParsedSegment:
+    # A normalized segment split into literal bytes and ControlBlocks, see parse_segment.
+    size: int
+    parts: list
+
+# Segments of b0801000.mpt are reflowed as battle text, all others as dialogue.
+def segment_class(filename):
+    return 'battle' if filename == 'b0801000.mpt' else 'dialogue'
+
+# Battle text is rendered in a smaller font, so its lines can be longer.
+reflow_limits = {'battle': 45, 'dialogue': 43}
+
+# Normalize a segment and parse its control blocks. Only config.rules is used, so the result can be
+# rendered for every gender, lang and yuusha.
+def parse_segment(segment, config):
+    # Strip %0 control characters and special characters that aren't rendered correctly in English.
+    with profiler.span('normalize', 'segment'):
+        normalized_segment = load_substitution_tables(config.rules)['normalize'].apply(segment)
+    with profiler.span('parse control chars', 'segment'):
+        return ParsedSegment(len(segment), parse_control_chars(normalized_segment))
+
+# Render a parsed segment for config.
 # The resulting segment should be the exact same length as the original segment.
-def process_segment(filename, segment):
-    size = len(segment)
+def render_segment(filename, parsed_segment, config, stats=None):
+    size = parsed_segment.size
 
-    # Strip all %0 control characters.
-    segment = segment.replace(b'%0', b'')
-
-    # Strip or replace special characters that aren't rendered correctly in English and show up as "%".
-    segment = segment.replace(b'\xe2\x80\x94', b'-')
-    segment = segment.replace(b'\xe2\x80\x98', b'"')
-    segment = segment.replace(b'\xe2\x80\x99', b'"')
-    segment = segment.replace(b'\xe3\x88\xa1', b'')
-    segment = segment.replace(b'\xe2\x93\x86', b'')
-    segment = segment.replace(b'\xe2\x93\x87', b'')
-    segment = segment.replace(b'\xe2\x93\x95', b'')
-    segment = segment.replace(b'\xe2\x93\x96', b'')
-    segment = segment.replace(b'\xe2\x93\x97', b'')
-    segment = segment.replace(b'\xe2\x93\x98', b'')
-    segment = segment.replace(b'\xe2\x93\x99', b'')
-    segment = segment.replace(b'\xe2\x99\xaa', b'~')
-
-    processed_segment = process_control_chars(segment)
+    with profiler.span('control chars', 'segment'):
+        processed_segment = render_control_chars(parsed_segment.parts, config, stats)
 
     # Fix grammar issues caused by replacements.
-    processed_segment = fix_grammar(processed_segment)
+    with profiler.span('grammar', 'segment'):
+        processed_segment = fix_grammar(processed_segment, config)
 
     # Hardcode protagonist name if given.
-    if len(mode_yuusha) > 0:
-        processed_segment = processed_segment.replace(b'%a00090',bytes(mode_yuusha,'ascii'))
+    if len(config.yuusha) > 0:
+        processed_segment = processed_segment.replace(b'%a00090',bytes(config.yuusha,'ascii'))
 
     # Reflow lines.
-    if (filename == 'b0801000.mpt'):
-        processed_segment = reflow_segment(processed_segment, True, 45, False)
-        # Special case logic: 
-        if processed_segment.find(b'appears!') >= 0 or processed_segment.find(b'appear!') >= 0:
-            # Enemy name announcements should end with newline.
-            processed_segment[len(processed_segment)-1] = ord('\n')
-        if processed_segment.find(b'Each party member receives') >= 0:
-            # Experience points message should not have any newlines.
-            processed_segment = bytearray(processed_segment.replace(b'\n', b' '))
-    else:
-        processed_segment = reflow_segment(processed_segment, True, 43, False)
-   
-    # Perform special case reflow.
-    segment_no_newlines = bytearray(processed_segment.replace(b'\n', b' '))
-
-    special_case_str = b'exchanges their %a00102 '
-    special_case_idx = segment_no_newlines.find(special_case_str)
-    if (special_case_idx >= 0):
-        processed_segment[special_case_idx + len(special_case_str) - 1] = ord(b'\n')
-    special_case_str = b'puts their %a00100 '
-    special_case_idx = segment_no_newlines.find(special_case_str)
-    if (special_case_idx >= 0):
-        processed_segment[special_case_idx + len(special_case_str) - 1] = ord(b'\n')
-    special_case_str = b'puts %a02100 '
-    special_case_idx = segment_no_newlines.find(special_case_str)
-    if (special_case_idx >= 0):
-        processed_segment[special_case_idx + len(special_case_str) - 1] = ord(b'\n')
-    special_case_str = b'takes %a02100 '
-    special_case_idx = segment_no_newlines.find(special_case_str)
-    if (special_case_idx >= 0):
-        processed_segment[special_case_idx + len(special_case_str) - 1] = ord(b'\n')
-    special_case_str = b" Your custom's most appreciated."
-    special_case_idx = segment_no_newlines.find(special_case_str)
-    if (special_case_idx >= 0):
-        processed_segment[special_case_idx] = ord(b'\n')
-
-    # Perform special case line replacements.
-    if segment_no_newlines.find(b"%a02010's %a00101 is exchanged for %a02180's %a00102.") >= 0:
-        processed_segment = bytearray(b"%a02010's %a00101 is exchanged for\n%a02180's %a00102.")
-    elif segment_no_newlines.find(b'%a02010 puts their %a00100 in a different place. ') >= 0:
-        processed_segment = bytearray(b'%a02010 puts their %a00100\nin a different place. ')
-    elif segment_no_newlines.find(b'%a00110 puts %a02100 in a different place in the bag. ') >= 0:
-        processed_segment = bytearray(b'%a00110 puts %a02100\nin a different place in the bag. ')
-    elif segment_no_newlines.find(b"I'll take that %a00100 off your hands for %a00620 gold coins. Okay?") >= 0:
-        processed_segment = bytearray(b"I'll take that %a00100 off your\nhands for %a00620 gold coins. Okay?")
-    elif segment_no_newlines.find(b"%a04100? I'll give you %a00620 gold coins for it. Okay?") >= 0:
-        processed_segment = bytearray(b"%a04100? I'll give you %a00620\ngold coins for it. Okay?")
-    # special case control character for yggdrasil leaf that doesn't have a good choice available.
-    elif segment_no_newlines.find(b'%a02010 mashes up the Yggdrasil leaf and administers it to %N180%Xthemself%Y%a02180%Z.') >= 0:
-        processed_segment = bytearray(b'%a02010 mashes up the\nYggdrasil leaf and administers it.')
-    # typo in original script
-    elif segment_no_newlines.find(b'*: May divine protection accompany the great , %a00090.') >= 0:
-        processed_segment = bytearray(b'*: May divine protection accompany the\ngreat %a00090.')
-    # better formatting for multiheal
-    elif segment_no_newlines.find(b"%a02010's wounds heal! ") >= 0:
-        processed_segment = bytearray(b"%a02010's wounds heal!\n")
-    elif segment_no_newlines.find(b"%a02180's wounds heal! ") >= 0:
-        processed_segment = bytearray(b"%a02180's wounds heal!\n")
-    elif segment_no_newlines.find(b"%a02010 casts %a00170! ") >= 0:
-        processed_segment = bytearray(b"%a02010 casts %a00170!\n")
-    elif (segment_no_newlines.find(b"t notice the party's ") >= 0):
-        # This line is rendered in small font and doesn't need any newlines.
-        processed_segment = segment_no_newlines
-    elif (segment_no_newlines.find(b"%a02180 takes %a02100 out of the bag.") >= 0):
-        processed_segment = segment_no_newlines
-    elif (segment_no_newlines.find(b"%a00120 puts %a02100 into the bag.") >= 0):
-        processed_segment = segment_no_newlines
-    elif (segment_no_newlines.find(b'%a02010 puts %a02100 in the bag.') >= 0):
-        processed_segment = segment_no_newlines
+    with profiler.span('reflow', 'segment'):
+        processed_segment = reflow_segment(processed_segment, True, reflow_limits[segment_class(filename)], False)
+
+    # Perform special case reflow and line replacements.
+    with profiler.span('special cases', 'segment'):
+        if (segment_class(filename) == 'battle'):
+            processed_segment = apply_battle_text_rules(processed_segment, stats)
+        processed_segment = apply_special_case_rules(processed_segment, stats)
 
     # Pad the processed segment to the same length as the original.
-    logging.info(f'Processed segment: {bytes(processed_segment)}')
-    while len(processed_segment) < size:
-        processed_segment.extend(b' ')
+    logging.debug('Processed segment: %s', processed_segment)
+    if stats is not None:
+        stats['segments'] += 1
+        stats['padding bytes'] += size - len(processed_segment)
+    processed_segment.extend(b' ' * (size - len(processed_segment)))
 
-    assert len(processed_segment) == size, f"ERROR: Processed segment size ({len(processed_segment)}) does not match original size ({size})"
+    if len(processed_segment) != size:
+        raise ValueError(f"ERROR: Processed segment size ({len(processed_segment)}) does not match original size ({size})")
 
     return processed_segment
 
+class SegmentCache:
+    # Bounded LRU of rendered segments shared by every file, since battle messages, shop lines and stock NPC
+    # lines repeat across the script. A rendered segment only depends on its segment class, bytes and config.
+    # Each worker process has its own cache.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        # Hits and misses are counted in the per-file stats by render_segment_cached, since each worker process
+        # has its own cache.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+segment_cache = SegmentCache(65536)
+
+
+# The record of a rendered segment kept for the --index: the special case rules that fired (comma separated)
+# and its padding bytes. A list, so it round trips through the PatchCache JSON unchanged.
+def segment_record(segment_stats):
+    return [','.join(sorted(key[len('rule '):] for key in segment_stats if key.startswith('rule '))), segment_stats['padding bytes']]
+
+# Render a segment through segment_cache. parsed_segments optionally caches parse_segment results by
+# (segment, config.rules), so a segment is only parsed once for all configs. If records is given, the
+# segment's record is appended to it.
+def render_segment_cached(filename, segment, config, stats=None, parsed_segments=None, records=None):
+    key = (segment_class(filename), segment, config)
+    entry = segment_cache.get(key)
+    hit = entry is not None
+    if not hit:
+        parse_key = (segment, config.rules)
+        if parsed_segments is None:
+            parsed_segment = parse_segment(segment, config)
+        elif parse_key in parsed_segments:
+            parsed_segment = parsed_segments[parse_key]
+        else:
+            parsed_segment = parsed_segments[parse_key] = parse_segment(segment, config)
+        segment_stats = Counter()
+        rendered = bytes(render_segment(filename, parsed_segment, config, segment_stats))
+        entry = (rendered, segment_stats, segment_record(segment_stats))
+        segment_cache.put(key, entry)
+    if stats is not None:
+        stats.update(entry[1])
+        stats['segment cache hits' if hit else 'segment cache misses'] += 1
+    if records is not None:
+        records.append(entry[2])
+    return entry[0]
+
+# Process a single "segment" of dialogue.
+def process_segment(filename, segment, config, stats=None):
+    return bytearray(render_segment_cached(filename, bytes(segment), config, stats))
+
 def special_case_patch(filename, data):
     patched_data = data
     patched = False
     if filename == 'b1007000.mpt':
+        patched_data = bytes(patched_data)
         patched_data = patched_data.replace(b'@1Chapter 1: Ragnar McRyan and the Case of the Missing Children@', b'@1Chapter 1: Ragnar McRyan\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE@')
         patched_data = patched_data.replace(b'@1Chapter 2: Alena and the Journey to the Tourney@', b'@1Chapter 2: Alena\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE@')
         patched_data = patched_data.replace(b'@1Chapter 3: Torneko and the Extravagant Excavation@', b'@1Chapter 3: Torneko\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE\xFE@')
@@ -433,328 +1029,1016 @@ def special_case_patch(filename, data):
         patched = True
     return patched_data, patched
 
-def patch_file_en(filename):
+# Matches a single @a<nametag>@b<segment>@cN@ dialogue segment.
+segment_pattern = re.compile(rb'@a(.*?)@b(.*?)(@c[0-3]@)', re.DOTALL)
+
+# Yield ((nametag_start, nametag_end), (segment_start, segment_end), segment_end_marker) for each
+# dialogue segment in data, without copying it. data may be any bytes-like object.
+def iter_segments(data):
+    for match in segment_pattern.finditer(data):
+        yield match.span(1), match.span(2), match.group(3)
+
+@dataclass
+class ParsedFile:
+    # A file split into dialogue segments. Parsed segments are cached by their text, so each one is only
+    # parsed once no matter how many variants are rendered.
+    filename: str
+    data: object
+    segments: list
+    parsed_segments: dict
+
+def parse_file(filename, data):
+    return ParsedFile(filename, data, list(iter_segments(data)), {})
+
+# The segment text to render for config. The ja language mode has no nametags, so the speaker name is
+# moved into the text.
+def config_segment(nametag, segment, config):
+    if config.lang == 'ja' and len(nametag) > 0:
+        # Strip off last char and add nametag*
+        return nametag + b'*' + segment[:len(segment)-1]
+    return segment
+
+# Render a parsed file for config and return the patched data. If records is given, the record of each
+# segment is appended to it, see segment_record.
+def render_file(parsed_file, config, stats=None, records=None):
+    filename = parsed_file.filename
+    data = parsed_file.data
+    size = len(data)
+
+    patched_data, patched = special_case_patch(filename, data)
+    if (patched):
+        assert len(patched_data) == size, f"Final size ({len(patched_data)}) does not match original size ({size})"
+        logging.info(f'Successfully applied special case patch file en/{filename}')
+        return patched_data
+
+    # The output is the same size as the input, so start from a copy and overwrite each segment in place. Bytes
+    # between segments and the segment markers stay as they are.
+    final_data = bytearray(data)
+
+    for (nametag_start, nametag_end), (segment_start, segment_end), segment_end_marker in parsed_file.segments:
+        nametag = bytes(data[nametag_start:nametag_end])
+
+        segment = config_segment(nametag, bytes(data[segment_start:segment_end]), config)
+        segmentSize = len(segment)
+
+        logging.debug('Processing segment (%d bytes): [%s] %s', segmentSize, nametag, segment)
+
+        # Process the segment, reusing the result if the same segment was already rendered for this config.
+        processedSegment = render_segment_cached(filename, segment, config, stats, parsed_file.parsed_segments, records)
+
+        # Write the processed segment after the @b marker. In ja mode there is no nametag, so the marker and the
+        # segment (which now starts with the nametag) move up to where the nametag was.
+        body_start = nametag_end if config.lang == 'en' else nametag_start
+        # Not an assert, which python -O strips: slice assigning a segment of the wrong size would silently
+        # resize final_data and shift every later byte.
+        if len(processedSegment) != segment_end - body_start - 2:
+            raise ValueError(f"Processed segment size ({len(processedSegment)}) does not match its slot ({segment_end - body_start - 2})")
+        final_data[body_start:body_start+2] = b'@b'
+        final_data[body_start+2:segment_end] = processedSegment
+
+
+    return final_data
+
+# Patch a single file once per config and return a (patched data, stats, segment records) tuple for each
+# config. The file is only parsed once. data may be any bytes-like object, e.g. a memoryview into a rom.
+def patch_file_variants(filename, configs, data):
     logging.info(f'Patching file {filename}')
-    with open(f'en/{filename}', "rb") as in_file, open (f'out/{mode_lang}/{filename}', "wb") as out_file:
+    logging.info(f'Size: {len(data)} bytes')
+
+    with profiler.span('patch file', 'file', file=filename):
+        parsed_file = parse_file(filename, data)
+        results = []
+        for config in configs:
+            stats = Counter()
+            records = []
+            with profiler.span('render file', 'file', file=filename, variant=variant_name(config)):
+                patched_data = render_file(parsed_file, config, stats, records)
+            results.append((patched_data, stats, records))
+
+    logging.info(f'Successfully patched file en/{filename}')
+
+    return results
+
+# Patch a single file from the en directory, writing the result to out/<lang>.
+def patch_file_en(filename, config, data=None):
+    if data is None:
+        with open(f'en/{filename}', "rb") as in_file:
+            data = in_file.read()
+    patched_data, stats, _ = patch_file_variants(filename, [config], data)[0]
+    with open(f'out/{config.lang}/{filename}', "wb") as out_file:
+        out_file.write(patched_data)
+    return stats
+
+class Patcher:
+    # Library API for patching in-process. Takes and returns bytes and does no file, rom or network I/O
+    # (apart from reading config.rules). Stats accumulate over every call.
+    #
+    #   from dqiv_patch import Patcher, PatchConfig
+    #   patched = Patcher(PatchConfig(gender='f')).patch_bytes('b0500000.mpt', data)
+    def __init__(self, config=PatchConfig()):
+        self.config = config
+        self.stats = Counter()
+
+    def patch_bytes(self, filename, data):
+        patched_data, stats, _ = patch_file_variants(filename, [self.config], data)[0]
+        self.stats.update(stats)
+        return bytes(patched_data)
+
+    def patch_segment(self, filename, segment):
+        return bytes(render_segment_cached(filename, bytes(segment), self.config, self.stats))
+
+    def verify(self, filename, data, patched_data):
+        return verify_file(filename, data, patched_data, self.config)
+
+class ProfileSpan:
+    # A span being timed by Profiler.span.
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.cpu_start = time.thread_time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        cpu = time.thread_time_ns() - self.cpu_start
+        wall = time.perf_counter_ns() - self.start
+        self.profiler.events.append({'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self.start / 1000, 'dur': wall / 1000,
+                                     'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': {**self.args, 'cpu_us': cpu / 1000}})
+
+# Profiler categories, from the outermost pipeline stages down to the steps of rendering a single segment.
+profile_categories = ['stage', 'file', 'segment']
+
+class Profiler:
+    # Wall and CPU time of pipeline stages, files and segment rendering steps with --profile, recorded as
+    # Chrome trace events (open the trace in chrome://tracing or Perfetto). While disabled, span() returns a
+    # shared no-op context manager, so instrumented code only pays for the call.
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.null_span = contextlib.nullcontext()
+
+    def span(self, name, category='stage', **args):
+        if not self.enabled:
+            return self.null_span
+        return ProfileSpan(self, name, category, args)
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def log_summary(self):
+        totals = {}
+        for event in self.events:
+            calls, wall, cpu = totals.get((event['cat'], event['name']), (0, 0, 0))
+            totals[event['cat'], event['name']] = (calls + 1, wall + event['dur'], cpu + event['args']['cpu_us'])
+        for (category, name), (calls, wall, cpu) in sorted(totals.items(), key=lambda item: (profile_categories.index(item[0][0]), -item[1][1])):
+            summary_logger.info('Profile %-7s %-20s %7d calls %10.1f ms wall %10.1f ms cpu', category, name, calls, wall / 1000, cpu / 1000)
+        slowest = sorted((event for event in self.events if event['name'] == 'patch file'), key=lambda event: -event['dur'])[:5]
+        if slowest:
+            summary_logger.info('Slowest files: %s', ', '.join(f'{event["args"]["file"]} ({event["dur"] / 1000:.1f} ms)' for event in slowest))
+
+profiler = Profiler()
+
+def start_profiling(path_to_trace=None, path_to_pstats=None):
+    # Profile the rest of the run, writing the trace and cProfile stats when it ends, however it ends. cProfile
+    # only sees this process, so use --jobs 1 to profile patching with it.
+    profile = None
+    if path_to_pstats is not None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    if path_to_trace is not None:
+        profiler.enabled = True
+    run = profiler.span('run')
+    run.__enter__()
+
+    def stop():
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(path_to_pstats)
+            summary_logger.info('Wrote cProfile stats to %s', path_to_pstats)
+        if path_to_trace is not None:
+            run.__exit__(None, None, None)
+            profiler.log_summary()
+            profiler.write_trace(path_to_trace)
+            summary_logger.info('Wrote trace to %s', path_to_trace)
+    atexit.register(stop)
+
+def configure_logging(level):
+    logging.basicConfig(format='%(message)s', stream=sys.stdout, level=level)
+
+def init_worker(log_level, segment_cache_size, profiling=False):
+    configure_logging(log_level)
+    logging.getLogger().setLevel(log_level)
+    segment_cache.max_entries = segment_cache_size
+    profiler.enabled = profiling
+
+# patch_file_variants for a worker process with --profile, also returning the events it recorded so they end
+# up in the trace.
+def patch_file_variants_profiled(filename, configs, data):
+    start = len(profiler.events)
+    results = patch_file_variants(filename, configs, data)
+    events = profiler.events[start:]
+    del profiler.events[start:]
+    return results, events
+
+@functools.lru_cache(maxsize=None)
+def patcher_version(rules=None):
+    # Hash of this script and the rules file, so cached files are invalidated whenever either changes.
+    version = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        version.update(f.read())
+    if rules is not None:
+        with open(rules, "rb") as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+class PatchCache:
+    # Content-addressed cache of patched files. Each entry is keyed by the input file, the patcher version and
+    # the config, and holds the patched data (<key>.mpt), and its stats and segment records (<key>.json).
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, filename, data, config):
+        key = hashlib.sha256()
+        key.update(patcher_version(config.rules).encode())
+        key.update(repr((filename, config.gender, config.lang, config.yuusha)).encode())
+        key.update(data)
+        return key.hexdigest()
+
+    def get(self, key):
+        # Return the cached (patched data, stats, segment records), or None if it isn't cached.
+        entry = os.path.join(self.path, key)
+        try:
+            with open(entry + ".mpt", "rb") as f:
+                data = f.read()
+            with open(entry + ".json") as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Mark the entry as recently used.
+        os.utime(entry + ".mpt")
+        self.hits += 1
+        return data, Counter(info['stats']), info['segments']
+
+    def put(self, key, data, stats, records):
+        entry = os.path.join(self.path, key)
+        with open(entry + ".json", "w") as f:
+            json.dump({'stats': stats, 'segments': records}, f)
+        # Write the data under a temporary name first so a partial entry is never read.
+        with open(entry + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(entry + ".tmp", entry + ".mpt")
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits in max_size.
+        entries = []
+        for f in os.listdir(self.path):
+            if f.endswith(".mpt"):
+                entry = os.path.join(self.path, f[:-len(".mpt")])
+                st = os.stat(entry + ".mpt")
+                entries.append((st.st_mtime, st.st_size, entry))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            for path in (entry + ".mpt", entry + ".json"):
+                if os.path.exists(path):
+                    os.remove(path)
+            total_size -= size
+
+# Sources yield a (filename, data) tuple for each mpt file to patch.
+def directory_source(path, filenames=None):
+    for filename in sorted(os.listdir(path)) if filenames is None else filenames:
+        if filename.endswith('.mpt'):
+            with profiler.span('read en', 'file', file=filename), open(f'{path}/{filename}', "rb") as in_file:
+                data = in_file.read()
+            yield filename, data
+
+class PatchError(Exception):
+    # Raised by patch_stream once every other file is done if any file failed to patch.
+    def __init__(self, errors):
+        # A (filename, exception) tuple for each file that failed.
+        self.errors = errors
+        super().__init__(', '.join(f'en/{filename}: {e!r}' for filename, e in errors))
+
+    def log(self):
+        for filename, e in self.errors:
+            logging.error(f'Failed to patch file en/{filename}: {e!r}')
+
+# Patch every file in files, a dict of filename to data, once per config and yield a (filename, [patched data
+# for each config]) tuple in filename order. Files found in the cache are reused as-is. With more than one job
+# the remaining files are spread across worker processes. Files that fail are left out of the stream, and a
+# PatchError listing them is raised once all other files are done. The stats for each config are added to
+# stats if given, and if records is given, records[filename] is set to the segment records for each config
+# before the file is yielded.
+def patch_stream(files, configs, jobs=1, cache=None, stats=None, records=None):
+    filenames = sorted(files)
+    errors = []
+
+    # (patched data, stats, segment records) by (filename, config index), and the indexes of the configs still to
+    # be patched.
+    results = {}
+    misses = {filename: list(range(len(configs))) for filename in filenames}
+    keys = {}
+    if cache is not None:
+        with profiler.span('cache lookup'):
+            for filename in filenames:
+                for i, config in enumerate(configs):
+                    keys[filename, i] = cache.key(filename, files[filename], config)
+                    cached = cache.get(keys[filename, i])
+                    if cached is not None:
+                        results[filename, i] = cached
+                misses[filename] = [i for i in range(len(configs)) if (filename, i) not in results]
+
+    executor = None
+    if jobs > 1 and sum(1 for filename in filenames if misses[filename]) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                       initargs=(logging.getLogger().level, segment_cache.max_entries, profiler.enabled))
+        # memoryviews into a rom can't be pickled, so send the worker a copy.
+        futures = {filename: executor.submit(patch_file_variants_profiled if profiler.enabled else patch_file_variants,
+                                             filename, [configs[i] for i in misses[filename]], bytes(files[filename]))
+                   for filename in filenames if misses[filename]}
+
+    try:
+        for filename in filenames:
+            if misses[filename]:
+                try:
+                    if executor is None:
+                        patched = patch_file_variants(filename, [configs[i] for i in misses[filename]], files[filename])
+                    else:
+                        patched = futures[filename].result()
+                except Exception as e:
+                    errors.append((filename, e))
+                    continue
+                if executor is not None and profiler.enabled:
+                    patched, events = patched
+                    profiler.events += events
+                for i, result in zip(misses[filename], patched):
+                    results[filename, i] = result
+                    if cache is not None:
+                        cache.put(keys[filename, i], *result)
+            for i, config in enumerate(configs):
+                file_stats = results[filename, i][1]
+                log_file_summary(filename if len(configs) == 1 else f'{filename} [{variant_name(config)}]', file_stats)
+                if stats is not None:
+                    stats[i].update(file_stats)
+            if records is not None:
+                records[filename] = [results[filename, i][2] for i in range(len(configs))]
+            yield filename, [results.pop((filename, i))[0] for i in range(len(configs))]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if errors:
+        raise PatchError(errors)
+
+# Verification checks each patched file against its input without relying on asserts, which python -O strips.
+leftover_code_pattern = re.compile(rb'%[XYZ0]')
+join_patterns = [rule.pattern for rule in special_case_rules + battle_text_rules if rule.action == 'join']
+
+# Return a list of problems found in the patched file, each a dict with the segment index and offset.
+def verify_file(filename, original, patched, config):
+    original = memoryview(original)
+    patched = memoryview(patched)
+    if len(patched) != len(original):
+        return [{'kind': 'size', 'segment': None, 'offset': None, 'detail': f'{len(patched)} bytes, expected {len(original)}'}]
+
+    expected, special_cased = special_case_patch(filename, original)
+    if special_cased:
+        # Special cased files are not processed segment by segment.
+        if patched != memoryview(expected):
+            return [{'kind': 'special case', 'segment': None, 'offset': None, 'detail': 'does not match the special case patch'}]
+        return []
+
+    problems = []
+    # reflow_segment only breaks a line once it is longer than the reflow limit, so lines can be one char longer.
+    limit = reflow_limits[segment_class(filename)] + 1
+    pointer = 0
+    for index, ((nametag_start, nametag_end), (segment_start, segment_end), segment_end_marker) in enumerate(iter_segments(original)):
+        # Everything between segments, and the @a marker, is copied as is. The nametag is moved into the text in ja mode.
+        if patched[pointer:nametag_start] != original[pointer:nametag_start]:
+            problems.append({'kind': 'outside bytes', 'segment': index, 'offset': pointer, 'detail': 'bytes before the segment changed'})
+        body_start = nametag_end if config.lang == 'en' else nametag_start
+        if patched[body_start:body_start+2] != b'@b' or (config.lang == 'en' and patched[nametag_start:nametag_end] != original[nametag_start:nametag_end]):
+            problems.append({'kind': 'marker', 'segment': index, 'offset': body_start, 'detail': 'nametag or @b marker moved'})
+        pointer = segment_end + len(segment_end_marker)
+        if patched[segment_end:pointer] != segment_end_marker:
+            problems.append({'kind': 'marker', 'segment': index, 'offset': segment_end, 'detail': f'{segment_end_marker} marker moved'})
+
+        body = bytes(patched[body_start+2:segment_end])
+        code = leftover_code_pattern.search(body)
+        if code is not None:
+            problems.append({'kind': 'leftover code', 'segment': index, 'offset': body_start + 2 + code.start(), 'detail': code.group().decode('latin-1')})
+        if not any(pattern in body.replace(b'\n', b' ') for pattern in join_patterns):
+            # Segments joined by a special case rule are rendered in a small font and may be longer.
+            for line in body.split(b'\n'):
+                line = line.rstrip(b' ')
+                if len(line) > limit:
+                    problems.append({'kind': 'line length', 'segment': index, 'offset': body_start + 2 + body.find(line), 'detail': f'{len(line)} > {limit} chars'})
+    if patched[pointer:] != original[pointer:]:
+        problems.append({'kind': 'outside bytes', 'segment': None, 'offset': pointer, 'detail': 'bytes after the last segment changed'})
+    return problems
+
+# Verify the patched files as they pass through, appending a report entry for every problem to problems.
+def verify_stream(stream, files, configs, problems):
+    for filename, patched in stream:
+        for config, patched_data in zip(configs, patched):
+            with profiler.span('verify', 'file', file=filename):
+                file_problems = verify_file(filename, files[filename], patched_data, config)
+            for problem in file_problems:
+                problem = {'file': filename, 'variant': variant_name(config), **problem}
+                logging.error(f'Verification failed for {filename} [{variant_name(config)}]: {problem["kind"]} in segment {problem["segment"]} at 0x{problem["offset"] or 0:X}: {problem["detail"]}')
+                problems.append(problem)
+        yield filename, patched
+
+def write_verify_report(path, files, configs, problems):
+    report = {'ok': not problems, 'files': len(files), 'variants': [variant_name(config) for config in configs], 'problems': problems}
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    summary_logger.info('Verification: %d problems in %d files, report written to %s', len(problems), len({problem['file'] for problem in problems}), path)
+
+# The segment index stores one row per segment and variant in SQLite, so lines can be looked up with the
+# query command instead of grepping --debug logs, and single segments can be re-patched with --segment.
+index_schema = '''CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    gender TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    yuusha TEXT NOT NULL,
+    segment INTEGER NOT NULL,     -- index of the segment in its file
+    offset INTEGER NOT NULL,      -- offset and length of the segment text in the input file
+    length INTEGER NOT NULL,
+    out_offset INTEGER NOT NULL,  -- offset and length of the segment text in the patched file
+    out_length INTEGER NOT NULL,
+    nametag TEXT NOT NULL,
+    control_codes TEXT NOT NULL,  -- comma separated, e.g. "%A,%H"
+    rules TEXT NOT NULL,          -- comma separated special case rules that fired
+    slack INTEGER NOT NULL,       -- padding bytes after the patched text
+    max_line INTEGER NOT NULL,    -- longest patched line
+    reflow_limit INTEGER NOT NULL,
+    text TEXT NOT NULL            -- patched text
+)'''
+index_columns = ['file', 'gender', 'lang', 'yuusha', 'segment', 'offset', 'length', 'out_offset', 'out_length', 'nametag',
+                 'control_codes', 'rules', 'slack', 'max_line', 'reflow_limit', 'text']
+# Control codes that start a block (%X/%Y/%Z and %B/%C only appear inside them), plus %0.
+index_code_pattern = re.compile(rb'%[ADHLMNO0]')
+
+def open_index(path):
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.execute(index_schema)
+    db.execute('CREATE INDEX IF NOT EXISTS segments_file ON segments (file, gender, lang, yuusha, segment)')
+    return db
+
+def index_row(filename, index, nametag, segment, offset, out_offset, text, config, record):
+    return {'file': filename, 'gender': config.gender, 'lang': config.lang, 'yuusha': config.yuusha, 'segment': index,
+            'offset': offset, 'length': len(segment), 'out_offset': out_offset, 'out_length': len(text),
+            'nametag': nametag.decode('utf-8', 'replace'),
+            'control_codes': ','.join(sorted(set(code.decode('latin-1') for code in index_code_pattern.findall(segment)))),
+            'rules': record[0],
+            'slack': record[1],
+            'max_line': max(len(line.rstrip(b' ')) for line in text.split(b'\n')),
+            'reflow_limit': reflow_limits[segment_class(filename)],
+            'text': text.decode('utf-8', 'replace')}
+
+# Index one patched file from the segment records collected while it was rendered, see render_file.
+def index_file(db, filename, data, patched_data, config, records):
+    if special_case_patch(filename, data)[1]:
+        # Special cased files are not patched segment by segment.
+        return
+    rows = []
+    for index, (((nametag_start, nametag_end), (segment_start, segment_end), _), record) in enumerate(zip(iter_segments(data), records)):
+        nametag = bytes(data[nametag_start:nametag_end])
+        out_offset = (nametag_end if config.lang == 'en' else nametag_start) + 2
+        rows.append(index_row(filename, index, nametag, bytes(data[segment_start:segment_end]), segment_start, out_offset,
+                              bytes(patched_data[out_offset:segment_end]), config, record))
+    db.execute('DELETE FROM segments WHERE file = ? AND gender = ? AND lang = ? AND yuusha = ?', (filename, config.gender, config.lang, config.yuusha))
+    db.executemany(f'INSERT INTO segments ({", ".join(index_columns)}) VALUES ({", ".join(":" + column for column in index_columns)})', rows)
+
+# Index the patched files as they pass through. records is the dict given to patch_stream.
+def index_stream(stream, files, configs, db, records):
+    for filename, patched in stream:
+        for config, patched_data, file_records in zip(configs, patched, records.pop(filename)):
+            with profiler.span('index', 'file', file=filename):
+                index_file(db, filename, files[filename], patched_data, config, file_records)
+        yield filename, patched
+    db.commit()
+
+def query_index(args):
+    db = open_index(args.db)
+    where, params = [], []
+    if args.query_file is not None:
+        where.append('file = ?')
+        params.append(args.query_file)
+    if args.code is not None:
+        where.append("instr(',' || control_codes || ',', ?) > 0")
+        params.append(f',{args.code},')
+    if args.rule is not None:
+        where.append("instr(',' || rules || ',', ?) > 0")
+        params.append(f',{args.rule},')
+    if args.text is not None:
+        where.append('instr(text, ?) > 0')
+        params.append(args.text)
+    if args.at_limit:
+        where.append('max_line >= reflow_limit')
+    if args.where is not None:
+        where.append(f'({args.where})')
+    sql = 'SELECT id, ' + ', '.join(index_columns) + ' FROM segments'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY file, gender, lang, yuusha, segment'
+    rows = [dict(zip(['id'] + index_columns, row)) for row in db.execute(sql, params)]
+    if args.json:
+        print(json.dumps(rows, indent=2, ensure_ascii=False))
+        return
+    for row in rows:
+        print(f'{row["id"]}\t{row["file"]}:{row["segment"]}\t0x{row["offset"]:X}\t[{variant_name(PatchConfig(row["gender"], row["lang"], row["yuusha"]))}]\t'
+              f'{row["nametag"]}\t{row["control_codes"]}\t{row["rules"]}\t{row["slack"]}\t{row["max_line"]}/{row["reflow_limit"]}\t{row["text"].rstrip()!r}')
+
+def repatch_segment(db, segment_id, rules=None, manual=False, variants=False):
+    # Re-patch a single indexed segment from en and overwrite just its span in the patched rom, or in out with
+    # manual. The segment must still be at the same offset and have the same length as when it was indexed.
+    row = db.execute(f'SELECT {", ".join(index_columns)} FROM segments WHERE id = ?', (segment_id,)).fetchone()
+    if row is None:
+        raise ValueError(f'No segment with id {segment_id} in the index')
+    row = dict(zip(index_columns, row))
+    config = PatchConfig(row['gender'], row['lang'], row['yuusha'], rules)
+    filename = row['file']
+    with open(f'en/{filename}', "rb") as in_file:
         data = in_file.read()
-        size = len(data)
-
-        logging.info(f'Size: {size} bytes')
-
-        data, patched = special_case_patch(filename, data)
-        if (patched):
-            out_file.write(data)
-            assert len(data) == size, f"Final size ({len(data)}) does not match original size ({size})"
-            logging.info(f'Successfully applied special case patch file en/{filename}')
-            return
-
-        final_data = bytearray("", 'utf-8')
-
-        pointer = 0
-        segment_start = None
-        segment_end = None
-        nametag = b''
-        while pointer <= size:
-            if segment_start == None:
-                # Need to look for a new segment start.
-                if data[pointer:pointer+2] == b'@a':
-                    # Look for the nametag end marker
-                    pointer = pointer+2
-                    nametag_start = pointer
-                    nametag_len = 0
-                    while data[pointer:pointer+2] != b'@b':
-                        nametag_len += 1
-                        pointer += 1
-                    nametag = data[nametag_start:nametag_start + nametag_len]
-
-                    # Write the segment start marker
-                    final_data.extend(b'@a')
-                    if mode_lang == 'en':
-                        final_data.extend(nametag)
-                    final_data.extend(b'@b')
-
-                    segment_start = pointer+2
-                elif pointer < size:
-                    # Write any bytes encountered between segments to the output buffer
-                    final_data.append(data[pointer])
-
-                pointer += 1
-            elif segment_end == None:
-                # Need to look for a new segment end.
-                if data[pointer:pointer+4] == b'@c3@' or data[pointer:pointer+4] == b'@c2@' or data[pointer:pointer+4] == b'@c1@' or data[pointer:pointer+4] == b'@c0@':
-                    segment_end = pointer
-                    pointer = pointer+4
-                else:
-                    pointer += 1
-            else:
-                # We have a start and end to the segment.
-                segment = data[segment_start:segment_end]
-                if mode_lang == 'ja' and len(nametag) > 0:
-                    # Strip off last char and add nametag*
-                    segment_strip_last_char = segment[:len(segment)-1]
-                    nametag_part = bytearray(nametag)
-                    nametag_part.extend(b'*')
-                    segment = nametag_part
-                    segment.extend(segment_strip_last_char)
-                segmentSize = len(segment)
-
-                nametag_print = f' [{nametag}]' if len(nametag) > 0 else ''
-                logging.info(f'Processing segment ({segmentSize} bytes):{nametag_print} {segment}')
-
-                # Process the segment.
-                processedSegment = process_segment(filename, segment)
-                
-                # Write the processed segment.
-                final_data.extend(processedSegment)
-
-                # Write the segment end marker
-                final_data.extend(data[segment_end:segment_end+4])
-
-                # Reset the segment start/end pointers.
-                segment_start = None
-                segment_end = None
-                nametag = b''
-
-                # break
-
-        out_file.write(final_data)
-
-        assert len(final_data) == size, f"Final size ({len(final_data)}) does not match original size ({size})"
-
-        logging.info(f'Successfully patched file en/{filename}')
-
-def automatic_extract_repack():
-    path_to_ndstool = "ndstool"
-
-    # ndstool binary downloads
-    ndstool_links = {"linux aarch64" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-linux_aarch64.zip",
-                     "linux x86_64" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-1-linux_x86_64.zip",
-                     "mac osx" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-1-osx.zip",
-                     "win32" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-1-win32.zip",
-                     "windows" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-1-windows.zip",
-                     "windows i686" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-2-windows_i686.zip",
-                     "windows x86_64" : "https://github.com/fenwaypowers/ndstool/releases/download/2.1.2/ndstool-2.1.2-windows_x86_64.zip"}
-    
-    ndstool_string = "ndstool 2.1.2"
-
-    # Check if ndstool is installed
-    ndstool_found = False
-    correct_output =  "Nintendo DS rom tool 2.1.2 - Mar  2 2023\\nby Rafael Vuijk, Dave Murphy, Alexei Karpenko"
-
-    ndstool = subprocess.run(path_to_ndstool, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    if correct_output in str(ndstool.stdout):
-        ndstool_found = True
+    segments = list(iter_segments(data))
+    if row['segment'] >= len(segments):
+        raise ValueError(f'en/{filename} no longer has segment {row["segment"]}, patch the whole file instead')
+    (nametag_start, nametag_end), (segment_start, segment_end), _ = segments[row['segment']]
+    if segment_start != row['offset'] or segment_end - segment_start != row['length']:
+        raise ValueError(f'Segment {row["segment"]} of en/{filename} moved or changed length, patch the whole file instead')
+
+    nametag = bytes(data[nametag_start:nametag_end])
+    records = []
+    text = render_segment_cached(filename, config_segment(nametag, bytes(data[segment_start:segment_end]), config), config, records=records)
+    if len(text) != row['out_length']:
+        raise ValueError(f"Re-patched segment size ({len(text)}) does not match indexed size ({row['out_length']})")
+    if manual:
+        path_to_out = f'{variant_out_dir(config, variants)}/{filename}'
+        with open(path_to_out, "r+b") as out_file:
+            out_file.seek(row['out_offset'])
+            out_file.write(text)
+        logging.info(f'Re-patched segment {segment_id} ({filename}:{row["segment"]}) in {path_to_out}')
     else:
-        for possible_path in ["ndstool/ndstool", "ndstool/ndstool.exe"]:
-            if os.path.exists(possible_path):
-                ndstool_found = True
-                if possible_path.endswith(".exe"):
-                    path_to_ndstool = "ndstool\\ndstool.exe"
-                else:
-                    path_to_ndstool = possible_path
-
-    # If ndstool isn't found, install
-    if not ndstool_found:
-
-        do_not_install_msg = ndstool_string + " is required for automatic rom patching. Use --manual if you wish to do everything manually."
-        
-        install = input("Could not find " + ndstool_string + " on your system. Download it? (Y/n): ")
-        if install in ["", "y", "Y"]:
-
-            dl_list = []
-            for i, link in enumerate(ndstool_links):
-                print("[" + str(i + 1) + "] " + link)
-                dl_list.append(link)
-
-            while(True):
-                selection = input("Select a version [1-" + str(len(dl_list)) + "] (n to cancel): ")
-                if selection in ["n", "N"]:
-                    print(do_not_install_msg)
-                    sys.exit(1)
-
-                if selection.isdigit():
-                    if int(selection) in range(1,len(dl_list) + 1):
-                        break
-
-            selection = int(selection)
-
-            download = requests.get(ndstool_links[dl_list[selection - 1]])
-
-            if not os.path.exists("ndstool"):
-                os.makedirs("ndstool")
-
-            with open("ndstool/ndstool.zip",'wb') as f:
-                print("Downloading ndstool...")
-                f.write(download.content)
-
-                file_to_extract = "ndstool"
-                if "win" in dl_list[selection - 1]:
-                    file_to_extract += ".exe"
-                
-                with ZipFile("ndstool/ndstool.zip", 'r') as zObject:
-                    zObject.extract(file_to_extract, path="ndstool/")
-
-                print("ndstool downloaded.")
-
-
-            if file_to_extract.endswith(".exe"):
-                path_to_ndstool = "ndstool\\" + file_to_extract
-            else:
-                path_to_ndstool = "ndstool/" + file_to_extract
-                subprocess.run("chmod +x ndstool/ndstool", shell=True)               
-
-        else:
-            print(do_not_install_msg)
-            sys.exit(1)
+        writer = PatchedRomWriter(patched_rom_path(config), patched_rom_path(config), copy=False)
+        try:
+            writer.write_into("data/MESS/" + config.lang + "/" + filename, row['out_offset'], text)
+        finally:
+            writer.close()
+        logging.info(f'Re-patched segment {segment_id} ({filename}:{row["segment"]}) in {patched_rom_path(config)}')
+
+    new_row = index_row(filename, row['segment'], nametag, bytes(data[segment_start:segment_end]), segment_start, row['out_offset'], text, config, records[0])
+    db.execute(f'UPDATE segments SET {", ".join(column + " = :" + column for column in index_columns)} WHERE id = :id', {**new_row, 'id': segment_id})
+    db.commit()
+
+# Sinks consume the patched files from patch_stream.
+def write_out_dirs(stream, out_dirs):
+    for out_dir in out_dirs:
+        os.makedirs(out_dir, exist_ok=True)
+    for filename, patched in stream:
+        with profiler.span('write out', 'file', file=filename):
+            for out_dir, patched_data in zip(out_dirs, patched):
+                with open(f'{out_dir}/{filename}', "wb") as out_file:
+                    out_file.write(patched_data)
+
+def write_roms(stream, configs, writers, output='rom'):
+    # Replace the files in data/MESS/<lang> of each patched rom as they arrive. The writers are futures, so
+    # copying the JA rom overlaps with reading the sources and patching the first files. With output 'bps' or
+    # 'both', a BPS patch against the JA rom is written next to each rom, and with 'bps' the rom is removed.
+    # If the stream fails, the roms are removed too, rather than left with some files still in Japanese.
+    complete = False
+    try:
+        for filename, patched in stream:
+            with profiler.span('write rom', 'file', file=filename):
+                for writer, config, patched_data in zip(writers, configs, patched):
+                    writer.result().replace("data/MESS/" + config.lang + "/" + filename, patched_data)
+        complete = True
+    finally:
+        wait(writers)
+        with profiler.span('close rom'):
+            for writer in writers:
+                if writer.exception() is None:
+                    writer.result().close()
+                    if not complete:
+                        os.remove(writer.result().path_to_dst_rom)
+    for writer in writers:
+        writer.result()
+    print("Rom repacked!")
 
+    if output in ['bps', 'both']:
+        for writer in writers:
+            path_to_rom = writer.result().path_to_dst_rom
+            path_to_patch = os.path.splitext(path_to_rom)[0] + ".bps"
+            with profiler.span('bps patch', rom=path_to_rom):
+                size = write_bps_patch(writer.result(), path_to_patch)
+            print(f"Wrote patch {path_to_patch} ({size} bytes)")
+            if output == 'bps':
+                os.remove(path_to_rom)
+
+def variant_out_dir(config, variants=False):
+    return f'out/{variant_name(config)}/{config.lang}' if variants else f'out/{config.lang}'
+
+def patched_rom_path(config):
+    return "patched/" + "Dragon Quest IV Party Chat Patched [" + variant_name(config) + "].nds"
+
+def write_roms_in_place(stream, configs, roms=None):
+    # Update the roms written by write_roms, e.g. when watching for changes. If roms, the closed writers from
+    # write_roms, are given, the ranges written here are added to theirs and the BPS patch next to each rom is
+    # rewritten, so it still turns the JA rom into the updated one.
+    writers = [PatchedRomWriter(patched_rom_path(config), patched_rom_path(config), copy=False) for config in configs]
+    try:
+        for filename, patched in stream:
+            with profiler.span('write rom', 'file', file=filename):
+                for writer, config, patched_data in zip(writers, configs, patched):
+                    writer.replace("data/MESS/" + config.lang + "/" + filename, patched_data)
+    finally:
+        for writer in writers:
+            writer.close()
+        for rom, writer in zip(roms or [], writers):
+            rom.written += writer.written
+
+    for rom in roms or []:
+        path_to_patch = os.path.splitext(rom.path_to_dst_rom)[0] + ".bps"
+        with profiler.span('bps patch', rom=rom.path_to_dst_rom):
+            write_bps_patch(rom, path_to_patch)
+        logging.info(f'Updated patch {path_to_patch}')
+
+def variant_name(config):
+    return "yuusha=" + config.yuusha + " gender=" + config.gender + " lang=" + config.lang
+
+def count_rules_fired(stats):
+    return sum(count for key, count in stats.items() if key.startswith('rule '))
+
+def log_file_summary(filename, stats):
+    summary_logger.info('%s: %d segments, %d control blocks reduced, %d rules fired, %d padding bytes',
+                        filename, stats['segments'], stats['control blocks'], count_rules_fired(stats), stats['padding bytes'])
+
+def log_rule_coverage(stats):
+    for rule in special_case_rules + battle_text_rules:
+        logging.debug('Special case rule %s fired %d times', rule.name, stats[f'rule {rule.name}'])
+    unused = [rule.name for rule in special_case_rules + battle_text_rules if stats[f'rule {rule.name}'] == 0]
+    if unused:
+        logging.debug(f'Special case rules that never fired: {", ".join(unused)}')
+
+def automatic_extract_repack(configs, stages):
     # Check if en folder is missing us nds mpt files
-    us_nds_mptlist = ['b0000000.mpt', 'b0001000.mpt', 'b0002000.mpt', 'b0003000.mpt', 'b0004000.mpt', 'b0005000.mpt', 'b0006000.mpt', 'b0007000.mpt', 'b0008000.mpt', 'b0009000.mpt', 'b0010000.mpt', 'b0011000.mpt', 'b0012000.mpt', 'b0014000.mpt', 'b0015000.mpt', 'b0016000.mpt', 'b0017000.mpt', 'b0018000.mpt', 'b0019000.mpt', 'b0025000.mpt', 'b0026000.mpt', 'b0027000.mpt', 'b0028000.mpt', 'b0029000.mpt', 'b0030000.mpt', 'b0031000.mpt', 'b0032000.mpt', 'b0033000.mpt', 'b0034000.mpt', 'b0035000.mpt', 'b0037000.mpt', 'b0038000.mpt', 'b0039000.mpt', 'b0040000.mpt', 'b0045000.mpt', 'b0046000.mpt', 'b0047000.mpt', 'b0049000.mpt', 'b0050000.mpt', 'b0051000.mpt', 'b0053000.mpt', 'b0054000.mpt', 'b0055000.mpt', 'b0065000.mpt', 'b0066000.mpt', 'b0067000.mpt', 'b0069000.mpt', 'b0070000.mpt', 'b0071000.mpt', 'b0072000.mpt', 'b0073000.mpt', 'b0075000.mpt', 'b0076000.mpt', 'b0077000.mpt', 'b0079000.mpt', 'b0080000.mpt', 'b0081000.mpt', 'b0082000.mpt', 'b0083000.mpt', 'b0084000.mpt', 'b0085000.mpt', 'b0086000.mpt', 'b0087000.mpt', 'b0088000.mpt', 'b0090000.mpt', 'b0091000.mpt', 'b0093000.mpt', 'b0094000.mpt', 'b0095000.mpt', 'b0096000.mpt', 'b0097000.mpt', 'b0098000.mpt', 'b0099000.mpt', 'b0100000.mpt', 'b0101000.mpt', 'b0102000.mpt', 'b0103000.mpt', 'b0104000.mpt', 'b0105000.mpt', 'b0106000.mpt', 'b0107000.mpt', 'b0109000.mpt', 'b0110000.mpt', 'b0112000.mpt', 'b0113000.mpt', 'b0115000.mpt', 'b0116000.mpt', 'b0118000.mpt', 'b0119000.mpt', 'b0120000.mpt', 'b0121000.mpt', 'b0122000.mpt', 'b0123000.mpt', 'b0124000.mpt', 'b0125000.mpt', 'b0126000.mpt', 'b0127000.mpt', 'b0128000.mpt', 'b0129000.mpt', 'b0130000.mpt', 'b0145000.mpt', 'b0146000.mpt', 'b0148000.mpt', 'b0149000.mpt', 'b0150000.mpt', 'b0151000.mpt', 'b0152000.mpt', 'b0153000.mpt', 'b0154000.mpt', 'b0155000.mpt', 'b0156000.mpt', 'b0157000.mpt', 'b0200000.mpt', 'b0600000.mpt', 'b0601000.mpt', 'b0602000.mpt', 'b0606000.mpt', 'b0801000.mpt', 'b0802000.mpt', 'b0803000.mpt', 'b0804000.mpt', 'b0805000.mpt', 'b0806000.mpt', 'b0807000.mpt', 'b0808000.mpt', 'b0810000.mpt', 'b0811000.mpt', 'b0812000.mpt', 'b0813000.mpt', 'b0814000.mpt', 'b0815000.mpt', 'b0816000.mpt', 'b0820000.mpt', 'b0821000.mpt', 'b0822000.mpt', 'b0823000.mpt', 'b0824000.mpt', 'b0825000.mpt', 'b0830000.mpt', 'b0831000.mpt', 'b0832000.mpt', 'b0833000.mpt', 'b0834000.mpt', 'b0901000.mpt', 'b1000000.mpt', 'b1001000.mpt', 'b1002000.mpt', 'b1003000.mpt', 'b1004000.mpt', 'b1005000.mpt', 'b1006000.mpt', 'b1007000.mpt', 'b1010000.mpt']
-    move_mpt_files = False
+    read_us_rom = False
     for nds_mpt in us_nds_mptlist:
         if not os.path.exists("en/" + nds_mpt):
-            move_mpt_files = True
-    
-    path_to_us_nds_files = "roms/" + "us" + "/data/data/MESS/en"
+            read_us_rom = True
 
-    # Check if US rom needs to be extraced
-    extract_us_rom = False
-    for nds_mpt in us_nds_mptlist:
-        if not os.path.exists(path_to_us_nds_files + "/" + nds_mpt):
-            extract_us_rom = True
-    
-    # Extract JA and possibly US rom
-    extract_roms(path_to_ndstool, extract_us_rom)
-
-    # Move US NDS mpt files from extracted folder to en
-    if move_mpt_files:
-        move_nds_mpt()
-    
-    # Check if obb mpt files need to be extraced
-    obb_mpt_list = ['assets/msg/en/b0500000.mpt', 'assets/msg/en/b0501000.mpt', 'assets/msg/en/b0502000.mpt', 'assets/msg/en/b0503000.mpt', 'assets/msg/en/b0504000.mpt', 'assets/msg/en/b0505000.mpt', 'assets/msg/en/b0506000.mpt', 'assets/msg/en/b0507000.mpt', 'assets/msg/en/b0508000.mpt', 'assets/msg/en/b0509000.mpt', 'assets/msg/en/b0512000.mpt', 'assets/msg/en/b0513000.mpt', 'assets/msg/en/b0516000.mpt', 'assets/msg/en/b0517000.mpt', 'assets/msg/en/b0520000.mpt', 'assets/msg/en/b0521000.mpt', 'assets/msg/en/b0522000.mpt', 'assets/msg/en/b0523000.mpt', 'assets/msg/en/b0524000.mpt', 'assets/msg/en/b0525000.mpt', 'assets/msg/en/b0526000.mpt', 'assets/msg/en/b0527000.mpt', 'assets/msg/en/b0528000.mpt',
-            'assets/msg/en/b0529000.mpt', 'assets/msg/en/b0530000.mpt', 'assets/msg/en/b0531000.mpt', 'assets/msg/en/b0532000.mpt', 'assets/msg/en/b0533000.mpt', 'assets/msg/en/b0534000.mpt', 'assets/msg/en/b0535000.mpt', 'assets/msg/en/b0536000.mpt', 'assets/msg/en/b0537000.mpt', 'assets/msg/en/b0538000.mpt', 'assets/msg/en/b0539000.mpt', 'assets/msg/en/b0540000.mpt', 'assets/msg/en/b0541000.mpt', 'assets/msg/en/b0542000.mpt', 'assets/msg/en/b0543000.mpt', 'assets/msg/en/b0544000.mpt', 'assets/msg/en/b0545000.mpt', 'assets/msg/en/b0547000.mpt', 'assets/msg/en/b0548000.mpt', 'assets/msg/en/b0549000.mpt', 'assets/msg/en/b0550000.mpt', 'assets/msg/en/b0551000.mpt', 'assets/msg/en/b0552000.mpt']
-    extract_obb_ = False
-    for obb in obb_mpt_list:
-        if not os.path.exists(obb.split("assets/msg/")[1]):
-            extract_obb_ = True
-    
-    # Extract the obb mpt files
-    if extract_obb_:
-        extract_obb()
-
-    return path_to_ndstool
-
-def extract_roms(path_to_ndstool: str, extract_us: bool):
-    regions = []
+    # Locate the JA and possibly US rom, and the obb
+    with profiler.span('find roms'):
+        roms = find_roms(read_us_rom)
+        path_to_obb = find_obb()
+    if path_to_obb is None and not any(fnmatch.fnmatchcase(f, "b05*.mpt") for f in os.listdir("en")):
+        print("Please provide a DQIV android .obb file in the roms folder.")
+        sys.exit(1)
+
+    # Start copying the JA rom once per config and reading the obb, then read the US NDS mpt files straight
+    # out of the US rom while those run
+    if not os.path.exists("patched"):
+        os.mkdir("patched")
+    writers = []
+    for config in configs:
+        path_to_rom = patched_rom_path(config)
+        print("Writing rom " + path_to_rom + "...")
+        writers.append(stages.submit(PatchedRomWriter, roms["ja"], path_to_rom))
+    obb_files = stages.submit(read_obb, path_to_obb) if path_to_obb is not None else None
+
+    source_files = {}
+    if read_us_rom:
+        with profiler.span('read us rom', rom=roms["us"]):
+            source_files = NdsRom(roms["us"]).listdir("data/MESS/en")
+    if obb_files is not None:
+        source_files.update(obb_files.result())
+
+    return writers, source_files
+
+@dataclass(frozen=True)
+class RomInfo:
+    path: str
+    game_code: str
+    version: int
+    problem: str = None
+
+rom_games = {"YIVE": "us", "YIVJ": "ja"}
+rom_info_cache = {}
+
+def identify_rom(path: str):
+    # Read the game code and rom version straight from the 0x200 byte header and check that the dump
+    # is sound. Results are cached by (path, size, mtime), so unchanged roms are only read once.
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key in rom_info_cache:
+        return rom_info_cache[key]
+
+    with open(path, "rb") as f:
+        header = f.read(0x200)
+
+    problem = None
+    if len(header) < 0x200:
+        problem = "file is smaller than an NDS header"
+    elif struct.unpack_from('<H', header, 0x15E)[0] != crc16(header[0:0x15E]):
+        problem = "header checksum does not match"
+    else:
+        fnt_offset, fnt_size, fat_offset, fat_size = struct.unpack_from('<IIII', header, 0x40)
+        rom_size = struct.unpack_from('<I', header, 0x80)[0]
+        if max(fnt_offset + fnt_size, fat_offset + fat_size, rom_size) > st.st_size:
+            problem = "rom is truncated"
+
+    info = RomInfo(path, header[0x0C:0x10].decode('latin-1'), header[0x1E] if len(header) > 0x1E else 0, problem)
+    rom_info_cache[key] = info
+    return info
+
+def find_roms(find_us: bool):
     roms = {"us" : "none",
             "ja" : "none"}
 
-    for r in os.listdir("roms"):
+    for r in sorted(os.listdir(path_to_roms)):
         if r.endswith(".nds"):
-            rom = subprocess.run(path_to_ndstool + " -i " + path_to_roms + "/" + r, shell=True, stdout=subprocess.PIPE)
-
-            if "YIVE (NTR-YIVE-USA)" in str(rom.stdout) and extract_us:
-                roms["us"] = path_to_roms + "/" + r
-            elif "YIVJ (NTR-YIVJ-JPN)" in str(rom.stdout):
-                roms["ja"] = path_to_roms + "/" + r
-
-    if roms["us"] == "none" and extract_us:
+            info = identify_rom(path_to_roms + "/" + r)
+            region = rom_games.get(info.game_code)
+            if region is None or (region == "us" and not find_us):
+                continue
+            if info.problem is not None:
+                print(f"{info.path} is a bad dump ({info.problem}). Please provide a clean {region.upper()} DQIV rom.")
+                sys.exit(1)
+            logging.debug('Found %s rom %s (version %d)', region.upper(), info.path, info.version)
+            roms[region] = info.path
+
+    if roms["us"] == "none" and find_us:
         print("Please provide a US DQIV rom in the roms folder.")
         sys.exit(1)
-    
-    if roms["us"] != "none":
-        regions.append("us")
 
     if roms["ja"] == "none":
         print("Please provide a JA DQIV rom in the roms folder.")
         sys.exit(1)
-    else:
-        regions.append("ja")
-    
-    # Extract JA/US roms
-    for region in regions:
-        path_to_region_folder = path_to_roms + "/" + region
-        if not os.path.exists(path_to_region_folder):
-            os.makedirs(path_to_region_folder)
-
-        print("Extracting " + region + " rom...")
-        subprocess.run(path_to_ndstool + " -x " + roms[region] + " -9 " + path_to_region_folder + "/arm9.bin -7 " + path_to_region_folder + "/arm7.bin -y9 " + path_to_region_folder + "/y9.bin -y7 " + path_to_region_folder + "/y7.bin -t " + path_to_region_folder + "/banner.bin -h " + path_to_region_folder + "/header.bin -d " + path_to_region_folder + "/data -y " + path_to_region_folder + "/overlay ", shell=True, stdout=subprocess.PIPE)
-        print("Extraction of " + region + " rom complete.")
-    
-def move_nds_mpt():
-    # Copy the US NDS mpt files to en
-    path_to_en_ds_files = path_to_roms + "/" + "us" + "/data/data/MESS/en"
-    for f in os.listdir(path_to_en_ds_files):
-        try:
-            shutil.copy(path_to_en_ds_files + "/" + f, "en/" + f)
-        except:
-            print("File en/" + f + " already exists. Skipping copying the file.")
-
-def extract_obb():
-    obb = "none"
-
-    # Locate the US and JA NDS roms as well as obb file
-    for r in os.listdir("roms"):
-        if r.endswith(".obb"):
-            obb = r
 
-    # Check if obb exists
-    if obb == "none":
-        print("Please provide a DQIV android .obb file in the roms folder.")
-        sys.exit(1)
-
-    # List of mpts to extract from the obb
-    mpt_list = ['assets/msg/en/b0500000.mpt', 'assets/msg/en/b0501000.mpt', 'assets/msg/en/b0502000.mpt', 'assets/msg/en/b0503000.mpt', 'assets/msg/en/b0504000.mpt', 'assets/msg/en/b0505000.mpt', 'assets/msg/en/b0506000.mpt', 'assets/msg/en/b0507000.mpt', 'assets/msg/en/b0508000.mpt', 'assets/msg/en/b0509000.mpt', 'assets/msg/en/b0512000.mpt', 'assets/msg/en/b0513000.mpt', 'assets/msg/en/b0516000.mpt', 'assets/msg/en/b0517000.mpt', 'assets/msg/en/b0520000.mpt', 'assets/msg/en/b0521000.mpt', 'assets/msg/en/b0522000.mpt', 'assets/msg/en/b0523000.mpt', 'assets/msg/en/b0524000.mpt', 'assets/msg/en/b0525000.mpt', 'assets/msg/en/b0526000.mpt', 'assets/msg/en/b0527000.mpt', 'assets/msg/en/b0528000.mpt',
-            'assets/msg/en/b0529000.mpt', 'assets/msg/en/b0530000.mpt', 'assets/msg/en/b0531000.mpt', 'assets/msg/en/b0532000.mpt', 'assets/msg/en/b0533000.mpt', 'assets/msg/en/b0534000.mpt', 'assets/msg/en/b0535000.mpt', 'assets/msg/en/b0536000.mpt', 'assets/msg/en/b0537000.mpt', 'assets/msg/en/b0538000.mpt', 'assets/msg/en/b0539000.mpt', 'assets/msg/en/b0540000.mpt', 'assets/msg/en/b0541000.mpt', 'assets/msg/en/b0542000.mpt', 'assets/msg/en/b0543000.mpt', 'assets/msg/en/b0544000.mpt', 'assets/msg/en/b0545000.mpt', 'assets/msg/en/b0547000.mpt', 'assets/msg/en/b0548000.mpt', 'assets/msg/en/b0549000.mpt', 'assets/msg/en/b0550000.mpt', 'assets/msg/en/b0551000.mpt', 'assets/msg/en/b0552000.mpt']
-    
-    # Extract the files and move the extracted files to root of en folder
-    print("Extracting files from obb...")
-    for mpt in mpt_list:
-        with ZipFile(path_to_roms + "/" + obb, 'r') as zObject:
-            zObject.extract(mpt, path="en/")
-            try:
-                os.rename("en/" + mpt, "en/" + mpt.split("assets/msg/en/")[1])
-            except:
-                print("File en/" + mpt + "already exists. Skipping copying the file...")
-    print("Extraction of obb files complete.")
-    shutil.rmtree("en/assets")
+    return roms
 
-def repack(mode_lang: str, mode_gender: str, path_to_ndstool: str):
-    
-    # Define path where mpt files will be replaced
-    path = path_to_roms + "/" + "repack" + "/data/data/MESS/" + mode_lang
+class NdsRom:
+    # Read-only view of the NitroFS files in an NDS rom. The rom is memory-mapped and files are
+    # handed out as zero-copy memoryviews, so nothing is extracted to disk.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        fnt_offset, fnt_size, self.fat_offset, fat_size = struct.unpack_from('<IIII', self.data, 0x40)
+        self.paths = read_nitrofs_paths(self.data, fnt_offset)
 
-    # Remove repack folder if it exists
-    if os.path.exists(path_to_roms + "/repack"):
-        shutil.rmtree(path_to_roms + "/repack")
+    def read(self, path: str):
+        start, end = struct.unpack_from('<II', self.data, self.fat_offset + self.paths[path] * 8)
+        return self.data[start:end]
 
-    # Create a copy of the extracted JA NDS rom folder called repack
-    shutil.copytree(path_to_roms + "/" + "ja", path_to_roms + "/" + "repack")
-    path_to_repack = path_to_roms + "/" + "repack"
+    def listdir(self, path: str):
+        # Map the name of each file directly inside the directory to its contents.
+        prefix = path.rstrip("/") + "/"
+        return {p[len(prefix):]: self.read(p) for p in self.paths if p.startswith(prefix) and "/" not in p[len(prefix):]}
 
-    # Remove all mpt's from path and move the mpt files in out to path
-    for i in os.listdir(path):
-        os.remove(path + "/" + i)
-    for j in os.listdir("out/" + mode_lang):
-        os.rename("out/" + mode_lang + "/" + j, path + "/" + j)
+def find_obb():
+    obb = None
 
-    path_to_repack = path_to_roms + "/" + "repack"
-
-    if not os.path.exists("patched"):
-        os.mkdir("patched")
-
-    # Repack the rom with ndstool
-    print("Repacking rom...")
-    repacking = subprocess.run(path_to_ndstool + " -c \"patched/" + "Dragon Quest IV Party Chat Patched [" + "yuusha=" + mode_yuusha + " gender=" + mode_gender + " lang=" + mode_lang + "].nds\"" + " -9 " + path_to_repack + "/arm9.bin -7 " + path_to_repack + "/arm7.bin -y9 " + path_to_repack + "/y9.bin -y7 " +
-                   path_to_repack + "/y7.bin -t " + path_to_repack + "/banner.bin -h " + path_to_repack + "/header.bin -d " + path_to_repack + "/data -y " + path_to_repack + "/overlay ", shell=True, stdout=subprocess.PIPE)
-    print("Rom repacked!")
-
-    # Remove the repack folder
-    shutil.rmtree(path_to_repack)
-
-    # Remove the ndstool zip
-    if os.path.exists("ndstool/ndstool.zip"):
-        os.remove("ndstool/ndstool.zip")
+    for r in os.listdir(path_to_roms):
+        if r.endswith(".obb"):
+            obb = path_to_roms + "/" + r
+
+    return obb
+
+def read_obb(path_to_obb: str):
+    # Read the party chat mpt files from the obb (a zip file) in one pass.
+    from zipfile import ZipFile
+    print("Reading files from obb...")
+    files = {}
+    with profiler.span('read obb', obb=path_to_obb), ZipFile(path_to_obb, 'r') as zObject:
+        for info in zObject.infolist():
+            if fnmatch.fnmatchcase(info.filename, obb_mpt_pattern):
+                files[posixpath.basename(info.filename)] = zObject.read(info)
+    print("Read " + str(len(files)) + " files from obb.")
+    return files
+
+def crc16(data, crc=0xFFFF):
+    # CRC-16/MODBUS, as used for the NDS header checksums.
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+def read_nitrofs_paths(fnt, fnt_offset=0):
+    # Walk the NitroFS file name table and map each file path to its file ID.
+    # Paths are relative to the NitroFS root, e.g. "data/MESS/en/b0000000.mpt".
+    paths = {}
+    directories = [(0xF000, "")]
+    while directories:
+        dir_id, prefix = directories.pop()
+        sub_table_offset, file_id = struct.unpack_from('<IH', fnt, fnt_offset + (dir_id & 0xFFF) * 8)
+        pointer = fnt_offset + sub_table_offset
+        while True:
+            type_len = fnt[pointer]
+            pointer += 1
+            if type_len == 0:
+                break
+            name_len = type_len & 0x7F
+            name = bytes(fnt[pointer:pointer+name_len]).decode('latin-1')
+            pointer += name_len
+            if type_len & 0x80:
+                sub_dir_id, = struct.unpack_from('<H', fnt, pointer)
+                pointer += 2
+                directories.append((sub_dir_id, prefix + name + "/"))
+            else:
+                paths[prefix + name] = file_id
+                file_id += 1
+    return paths
+
+FICLONE = 0x40049409
+
+def clone_file(src: str, dst: str):
+    # Copy a rom so that only the blocks which are later overwritten take up new space. On Linux this is a
+    # reflink where the filesystem supports it (btrfs, XFS), else an in-kernel copy_file_range.
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if fcntl is not None and hasattr(os, "copy_file_range"):
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+
+class PatchedRomWriter:
+    # Every patched file replaces an existing NitroFS file, so the output rom is a single copy of the
+    # source rom with those byte ranges overwritten. Files that no longer fit their slot are moved to
+    # the end of the rom. The FAT and header are written on close.
+    def __init__(self, path_to_src_rom: str, path_to_dst_rom: str, copy=True):
+        # With copy=False the destination rom is updated in place, e.g. a previously patched rom.
+        self.path_to_src_rom = path_to_src_rom
+        self.path_to_dst_rom = path_to_dst_rom
+        # (start, end) of every byte range written to the destination rom, see write_bps_patch.
+        self.written = []
+        if copy:
+            with profiler.span('copy rom', rom=path_to_dst_rom):
+                clone_file(path_to_src_rom, path_to_dst_rom)
+
+        self.rom = open(path_to_dst_rom, "r+b")
+        self.header = bytearray(self.rom.read(0x200))
+        fnt_offset, fnt_size, self.fat_offset, fat_size = struct.unpack_from('<IIII', self.header, 0x40)
+        self.rom.seek(fnt_offset)
+        fnt = self.rom.read(fnt_size)
+        self.rom.seek(self.fat_offset)
+        self.fat = bytearray(self.rom.read(fat_size))
+
+        self.paths = read_nitrofs_paths(fnt)
+        self.rom_size = struct.unpack_from('<I', self.header, 0x80)[0]
+        self.rom_end = max(self.rom_size, max(struct.unpack_from('<I', self.fat, i)[0] for i in range(4, fat_size, 8)))
+
+        # A file may grow up to the start of whatever comes next in the rom.
+        self.starts = sorted(set(struct.unpack_from('<I', self.fat, i)[0] for i in range(0, fat_size, 8)) | {fnt_offset, self.fat_offset, self.rom_end})
+
+    def replace(self, path, data):
+        if path not in self.paths:
+            # The JA game code only ever loads files listed in its own file name table, so rather than rewrite the
+            # table to add a file that would never be loaded, skip it.
+            logging.warning(f'**** WARNING ****: {path} does not exist in {self.path_to_src_rom}, skipping it (new files are not added to the rom)')
+            return
+        file_id = self.paths[path]
+        start, end = struct.unpack_from('<II', self.fat, file_id * 8)
+        slot_end = next((s for s in self.starts if s > start), self.rom_end)
+
+        if start + len(data) > slot_end:
+            # Relocate the file to the end of the rom, aligned like ndstool does.
+            start = (self.rom_end + 0x1FF) & ~0x1FF
+            self.rom_end = start + len(data)
+            logging.debug('Relocating %s to 0x%X', path, start)
+        elif start + len(data) < end:
+            # Clear the leftover bytes of the original file.
+            self.rom.seek(start + len(data))
+            self.rom.write(b'\xFF' * (end - start - len(data)))
+            self.written.append((start + len(data), end))
+
+        self.rom.seek(start)
+        self.rom.write(data)
+        self.written.append((start, start + len(data)))
+        struct.pack_into('<II', self.fat, file_id * 8, start, start + len(data))
+
+    def write_into(self, path, offset, data):
+        # Overwrite part of a file without moving it, e.g. a single re-patched segment.
+        start, end = struct.unpack_from('<II', self.fat, self.paths[path] * 8)
+        if offset + len(data) > end - start:
+            raise ValueError(f'Writing {len(data)} bytes at 0x{offset:X} overflows {path}')
+        self.rom.seek(start + offset)
+        self.rom.write(data)
+        self.written.append((start + offset, start + offset + len(data)))
+
+    def close(self):
+        self.rom.seek(self.fat_offset)
+        self.rom.write(self.fat)
+
+        # Grow the used rom size and device capacity if files were relocated, then fix the header CRC.
+        if self.rom_end > self.rom_size:
+            struct.pack_into('<I', self.header, 0x80, self.rom_end)
+            while (0x20000 << self.header[0x14]) < self.rom_end:
+                self.header[0x14] += 1
+        struct.pack_into('<H', self.header, 0x15E, crc16(self.header[0:0x15E]))
+        self.rom.seek(0)
+        self.rom.write(self.header)
+        self.rom.close()
+        self.written += [(self.fat_offset, self.fat_offset + len(self.fat)), (0, len(self.header))]
+
+def bps_number(n):
+    # BPS variable length number encoding.
+    encoded = bytearray()
+    while True:
+        x = n & 0x7F
+        n >>= 7
+        if n == 0:
+            encoded.append(0x80 | x)
+            return encoded
+        encoded.append(x)
+        n -= 1
+
+@functools.lru_cache(maxsize=None)
+def file_digest(path, mtime_ns):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return hashlib.sha1(data).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def file_crc32(path, mtime_ns):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return zlib.crc32(data)
+
+def make_bps_patch(source, target, regions, source_crc=None, block_size=64):
+    # Build a BPS patch turning source into target. Only the given (start, end) regions of target may differ
+    # from source, so everything else is a SourceRead and the regions are compared block by block, without
+    # scanning the whole rom. Blocks that differ become TargetReads.
+    patch = bytearray(b'BPS1') + bps_number(len(source)) + bps_number(len(target)) + bps_number(0)
+    if len(target) > len(source):
+        regions = regions + [(len(source), len(target))]
+
+    changed = []
+    for start, end in sorted(regions):
+        end = min(end, len(target))
+        for block in range(start, end, block_size):
+            block_end = min(block + block_size, end)
+            if block_end > len(source) or source[block:block_end] != target[block:block_end]:
+                if changed and changed[-1][1] >= block:
+                    changed[-1][1] = max(changed[-1][1], block_end)
+                else:
+                    changed.append([block, block_end])
+
+    offset = 0
+    for start, end in changed:
+        if start > offset:
+            patch += bps_number(((start - offset - 1) << 2) | 0)
+        patch += bps_number(((end - start - 1) << 2) | 1)
+        patch += target[start:end]
+        offset = end
+    if offset < len(target):
+        patch += bps_number(((len(target) - offset - 1) << 2) | 0)
+
+    if source_crc is None:
+        source_crc = zlib.crc32(source)
+    patch += struct.pack('<II', source_crc, zlib.crc32(target))
+    patch += struct.pack('<I', zlib.crc32(patch))
+    return patch
+
+def write_bps_patch(writer, path_to_patch):
+    # Write a BPS patch from the writer's source rom to its closed destination rom.
+    with open(writer.path_to_src_rom, "rb") as src, open(writer.path_to_dst_rom, "rb") as dst, \
+         mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as source, mmap.mmap(dst.fileno(), 0, access=mmap.ACCESS_READ) as target:
+        patch = make_bps_patch(source, target, writer.written, file_crc32(writer.path_to_src_rom, os.stat(writer.path_to_src_rom).st_mtime_ns))
+    with open(path_to_patch, "wb") as f:
+        f.write(patch)
+    return len(patch)
 
 if __name__ == "__main__":
     main()